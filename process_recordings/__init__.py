@@ -1 +1,14 @@
-from .chunk_recordings import export_teachings, export_final_files, parse_catalog, keep_sessions_with_export_name, find_renamed_sessions_dupes
\ No newline at end of file
+from .chunk_recordings import export_teachings, export_final_files, parse_catalog, keep_sessions_with_export_name, find_renamed_sessions_dupes, prune_stale_outputs
+from .catalog import Catalog, load_catalog
+from .catalog_diff import diff_catalogs, export_catalog_delta
+from .publish import publish_file, publish_files, move_file, remove_stale_outputs
+from .renditions import plan_renditions, source_fingerprint
+from .boundaries import detect_boundaries
+from .peaks import export_peaks
+from .watch import watch_catalog
+from .verify import verify_outputs, reexport_failed
+from .supervisor import run_supervised
+from .alignment import align_sources
+from .fingerprint import index_sources, find_duplicates
+from .loudness import measure_loudness, load_loudness_manifest
+from .retag import retag_outputs
@@ -0,0 +1,312 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from .boundaries import frame_levels
+from .catalog import load_catalog
+
+# resolution of the level envelopes that are cross-correlated
+FRAME_MS = 20
+# the global offset is searched for on a coarser envelope, which drift along the side doesn't smear
+COARSE_FRAME_MS = 500
+# how far a restored side may be trimmed or padded relative to the original
+MAX_OFFSET_MS = 120 * 1000
+# drift is followed with windows of the original searched for around the global offset
+WINDOW_MS = 60 * 1000
+HOP_MS = 5 * 60 * 1000
+SEARCH_MS = 5 * 1000
+# correlation (pearson) a match needs to be trusted
+MIN_SCORE = 0.5
+FLOOR_DB = -80
+
+_ALIGNMENT_FILE = '.alignment.json'
+# alignment each output was cut with
+_EXPORTS_FILE = '.aligned.jsonl'
+_exports_lock = threading.Lock()
+
+
+class SourceAlignment:
+    """Where the catalog timecodes of an original recording fall in its restored version.
+
+    anchors are (original ms, offset ms) points measured along the side: a timecode is shifted
+    by the offset interpolated between them, which follows a constant trim as well as a drift."""
+    __slots__ = ('anchors', 'score', 'drift_ppm', 'stamps')
+
+    def __init__(self, anchors, score, drift_ppm=0.0, stamps=None):
+        self.anchors = np.asarray(anchors, dtype=np.float64).reshape(-1, 2)
+        self.score = score
+        self.drift_ppm = drift_ppm
+        self.stamps = stamps  # (size, mtime_ns) of the original and restored files measured
+
+    @property
+    def is_identity(self):
+        """Whether the timecodes move by less than half a frame all along the side"""
+        return bool(np.all(np.abs(self.anchors[:, 1]) < FRAME_MS / 2))
+
+    @property
+    def offset_ms(self):
+        return int(round(self.anchors[0, 1]))
+
+    def map(self, ms):
+        """Restored position of an original timecode in ms (the drift continued past the first and last anchors)"""
+        t, offsets = self.anchors[:, 0], self.anchors[:, 1]
+        if len(t) > 1 and (ms < t[0] or ms > t[-1]):
+            i = 0 if ms < t[0] else -2
+            offset = offsets[i] + (ms - t[i]) * (offsets[i + 1] - offsets[i]) / (t[i + 1] - t[i])
+        else:
+            offset = np.interp(ms, t, offsets)
+        return max(0, int(round(ms + offset)))
+
+    def signature(self):
+        """Short hash of the anchors: two alignments with the same signature cut the same audio"""
+        anchors = [[int(t), round(float(o), 1)] for t, o in self.anchors]
+        return hashlib.sha1(json.dumps(anchors).encode()).hexdigest()[:12]
+
+    def to_json(self):
+        return {'offset_ms': self.offset_ms, 'drift_ppm': round(self.drift_ppm, 2), 'score': round(self.score, 3),
+                'anchors': [[int(t), round(float(o), 1)] for t, o in self.anchors], 'stamps': self.stamps}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['anchors'], data['score'], data.get('drift_ppm', 0.0), data.get('stamps'))
+
+    def __repr__(self):
+        return f'SourceAlignment(offset={self.offset_ms}ms, drift={self.drift_ppm:.1f}ppm, score={self.score:.2f})'
+
+
+def alignment_path(out_path):
+    """Alignment map of an export, kept next to its outputs"""
+    return Path(out_path) / _ALIGNMENT_FILE
+
+
+def load_alignment(path):
+    """{audio_file: SourceAlignment} of an alignment map file (empty if there is none)"""
+    path = Path(path)
+    if not path.is_file():
+        return {}
+    return {audio_file: SourceAlignment.from_json(data) for audio_file, data in json.loads(path.read_text()).items()}
+
+
+def save_alignment(alignment, path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_text(json.dumps({k: a.to_json() for k, a in sorted(alignment.items())}, ensure_ascii=False, indent=1))
+    tmp.replace(path)
+
+
+def resolve_alignment(alignment, out_path):
+    """The alignment an export applies: None loads the map saved in out_path (if any), False disables it,
+    a path is loaded, a dict is used as is. Sources whose restoration kept the original timing are left out:
+    they are cut as is"""
+    if alignment is None:
+        alignment = alignment_path(out_path)
+    if not alignment:
+        return {}
+    if not isinstance(alignment, dict):
+        alignment = load_alignment(alignment)
+    return {audio_file: a for audio_file, a in alignment.items() if not a.is_identity}
+
+
+def alignment_signature(aligned):
+    """Signature of the SourceAlignment a session is cut with, None when its catalog timecodes are used as is"""
+    return None if aligned is None else aligned.signature()
+
+
+def record_aligned_export(out_path, output, aligned):
+    """Append the alignment an output was cut with to the manifest of out_path (the last line of an output wins)"""
+    entry = {'output': str(Path(output).relative_to(out_path)), 'alignment': alignment_signature(aligned)}
+    with _exports_lock, open(Path(out_path) / _EXPORTS_FILE, 'a') as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+
+def move_aligned_exports(out_path, moves):
+    """Carry the stamps of moved outputs ((old, new) paths) over to their new path"""
+    exported = load_aligned_exports(out_path)
+    lines = [json.dumps({'output': str(Path(dst).relative_to(out_path)), 'alignment': exported[rel]},
+                        ensure_ascii=False)
+             for rel, dst in ((str(Path(src).relative_to(out_path)), dst) for src, dst in moves) if rel in exported]
+    if lines:
+        with _exports_lock, open(Path(out_path) / _EXPORTS_FILE, 'a') as f:
+            f.write(''.join(line + '\n' for line in lines))
+
+
+def load_aligned_exports(out_path):
+    """{output: alignment signature} of the outputs of out_path, an output missing being cut without alignment"""
+    path = Path(out_path) / _EXPORTS_FILE
+    if not path.is_file():
+        return {}
+    exports = {}
+    for line in path.read_text().splitlines():
+        if line.strip():
+            entry = json.loads(line)
+            exports[entry['output']] = entry['alignment']
+    return exports
+
+
+def _normalise(x):
+    x = x - x.mean(axis=-1, keepdims=True)
+    std = x.std(axis=-1, keepdims=True)
+    return x / np.where(std > 0, std, 1)
+
+
+def _pool(env, n):
+    """Envelope averaged over groups of n frames"""
+    if n <= 1:
+        return env
+    return env[:len(env) - len(env) % n].reshape(-1, n).mean(axis=1)
+
+
+def _fft_size(n):
+    return 1 << int(np.ceil(np.log2(max(n, 2))))
+
+
+def _refine(corr, i):
+    """Sub-frame position of a correlation peak (parabola through the peak and its neighbours)"""
+    if 0 < i < len(corr) - 1:
+        a, b, c = corr[i - 1], corr[i], corr[i + 1]
+        denom = a - 2 * b + c
+        if denom:
+            return i + 0.5 * (a - c) / denom
+    return float(i)
+
+
+def global_offset(original, restored, max_lag):
+    """(lag in frames, score) best aligning the restored envelope on the original one:
+    restored[t + lag] matches original[t]"""
+    n = _fft_size(len(original) + len(restored))
+    o, r = _normalise(original), _normalise(restored)
+    corr = np.fft.irfft(np.fft.rfft(r, n) * np.conj(np.fft.rfft(o, n)), n)
+    # lags -max_lag..max_lag, the negative ones wrapped at the end of the circular correlation
+    lags = np.concatenate((corr[n - max_lag:], corr[:max_lag + 1]))
+    i = int(np.argmax(lags))
+    return _refine(lags, i) - max_lag, float(lags[i]) / min(len(original), len(restored))
+
+
+def window_offsets(original, restored, lag, window, hop, search):
+    """(frame of the original, lag, score) of windows along the side, searched for within search frames
+    around lag, all correlated at once"""
+    starts = np.arange(0, len(original) - window + 1, hop)
+    starts = starts[(starts + lag - search >= 0) & (starts + lag + search + window <= len(restored))]
+    if not starts.size:
+        return []
+    span = window + 2 * search
+    windows = _normalise(original[starts[:, None] + np.arange(window)])
+    segments = restored[(starts + lag - search)[:, None] + np.arange(span)]
+    n = _fft_size(span + window)
+    corr = np.fft.irfft(np.fft.rfft(segments, n, axis=1) * np.conj(np.fft.rfft(windows, n, axis=1)), n, axis=1)
+    corr = corr[:, :2 * search + 1]
+    # normalise by the energy of each slice of the segment under the window: a pearson score per lag
+    csum = np.concatenate((np.zeros((len(starts), 1)), np.cumsum(segments, axis=1)), axis=1)
+    csum2 = np.concatenate((np.zeros((len(starts), 1)), np.cumsum(segments ** 2, axis=1)), axis=1)
+    k = np.arange(2 * search + 1)
+    sums = csum[:, k + window] - csum[:, k]
+    sums2 = csum2[:, k + window] - csum2[:, k]
+    std = np.sqrt(np.maximum(sums2 / window - (sums / window) ** 2, 1e-12))
+    scores = corr / (window * std)
+    best = np.argmax(scores, axis=1)
+    return [(int(s), lag - search + _refine(scores[j], b), float(scores[j, b]))
+            for j, (s, b) in enumerate(zip(starts, best))]
+
+
+def align_source(original, restored, frame_ms=FRAME_MS, max_offset_ms=MAX_OFFSET_MS, window_ms=WINDOW_MS,
+                 hop_ms=HOP_MS, search_ms=SEARCH_MS, min_score=MIN_SCORE):
+    """Measure the offset and drift of a restored recording against its original.
+
+    Both are decoded block by block into level envelopes of frame_ms frames, so memory stays at a
+    few MB whatever the length of the side. Returns a SourceAlignment, or None when they don't match."""
+    # digital silence (denoised in the restoration, hiss in the original) would dominate the correlation
+    env_o = np.maximum(frame_levels(original, frame_ms=frame_ms), FLOOR_DB).astype(np.float64)
+    env_r = np.maximum(frame_levels(restored, frame_ms=frame_ms), FLOOR_DB).astype(np.float64)
+    if not env_o.size or not env_r.size:
+        return None
+    pool = max(1, COARSE_FRAME_MS // frame_ms)
+    coarse_o, coarse_r = _pool(env_o, pool), _pool(env_r, pool)
+    lag = 0.0
+    if len(coarse_o) > 1 and len(coarse_r) > 1:
+        lag = global_offset(coarse_o, coarse_r,
+                            min(max_offset_ms // (frame_ms * pool), len(coarse_o) - 1, len(coarse_r) - 1))[0] * pool
+
+    # the side is accepted on its windows: drift lowers the score of a single correlation over the whole of it
+    matches = window_offsets(env_o, env_r, int(round(lag)), window_ms // frame_ms, hop_ms // frame_ms,
+                             search_ms // frame_ms)
+    good = [(s, l, sc) for s, l, sc in matches if sc >= min_score]
+    if len(good) < max(2, len(matches) // 2):
+        # too short (or too different) for windows: a constant offset, if the whole side matches
+        lag, score = global_offset(env_o, env_r, min(max_offset_ms // frame_ms, len(env_o) - 1, len(env_r) - 1))
+        if score < min_score:
+            return None
+        return SourceAlignment([(0, lag * frame_ms)], score)
+    anchors = np.array([((s + window_ms // frame_ms / 2) * frame_ms, l * frame_ms) for s, l, _ in good])
+    score = float(np.mean([sc for _, _, sc in good]))
+    # drift shows as offsets growing linearly along the side
+    slope = np.polyfit(anchors[:, 0], anchors[:, 1], 1)[0]
+    return SourceAlignment(anchors, score, drift_ppm=slope * 1e6)
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def catalog_sources(catalog):
+    """{audio_file: (Folder, filename)} of the timecoded recordings, keyed like parse_catalog"""
+    sources = {}
+    for row in load_catalog(catalog):
+        if '.' not in row['filename'] or row['start'] is None:
+            continue
+        audio_file = f"{row['Folder']}/{row['filename'][:row['filename'].rfind('.')]}"
+        sources.setdefault(audio_file, (row['Folder'], row['filename']))
+    return sources
+
+
+def align_sources(catalog, original_path, restored_path, out_path, max_workers=4, **params):
+    """Align the restored recordings of the catalog on their originals and save the map that the
+    exports to out_path apply to the catalog timecodes.
+
+    Sources already measured (and unchanged since) are kept, so this is cheap to run before each export."""
+    original_path, restored_path = Path(original_path), Path(restored_path)
+    path = alignment_path(out_path)
+    alignment = load_alignment(path)
+
+    to_align = {}
+    for audio_file, (folder, filename) in catalog_sources(catalog).items():
+        original, restored = original_path / folder / filename, restored_path / folder / filename
+        if not original.is_file() or not restored.is_file():
+            continue
+        stamps = [_stamp(original), _stamp(restored)]
+        if audio_file in alignment and alignment[audio_file].stamps == stamps:
+            continue
+        to_align[audio_file] = (original, restored, stamps)
+    print(f"Aligning {len(to_align)} restored recordings using {max_workers} workers...")
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_file = {executor.submit(align_source, original, restored, **params): audio_file
+                          for audio_file, (original, restored, _) in to_align.items()}
+        for completed, future in enumerate(concurrent.futures.as_completed(future_to_file), 1):
+            audio_file = future_to_file[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = None
+                print(f"  [{completed}/{len(to_align)}] ✗ {audio_file}: {e}")
+            if result is None:
+                failed.append(audio_file)
+                alignment.pop(audio_file, None)
+                continue
+            result.stamps = to_align[audio_file][2]
+            alignment[audio_file] = result
+            print(f"  [{completed}/{len(to_align)}] {audio_file}: {result}")
+
+    save_alignment(alignment, path)
+    if failed:
+        print(f"\nCould not align {len(failed)} recordings, their catalog timecodes are used as is:")
+        for audio_file in sorted(failed):
+            print(f"  - {audio_file}")
+    return alignment
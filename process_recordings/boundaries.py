@@ -0,0 +1,138 @@
+import concurrent.futures
+import csv
+from pathlib import Path
+
+import numpy as np
+
+from .catalog import load_catalog, to_timecode
+from .decode import stream_audio_blocks
+
+# columns of the sessions catalog that parse_catalog relies on, in the order of the spreadsheet
+CANDIDATE_COLUMNS = ['Folder', 'filename', 'start', 'end', 'duration', 'session number',
+                     'translation session number', 'export filename', 'export folder',
+                     'session export status', 'notes']
+_AUDIO_SUFFIXES = {'.wav', '.mp3', '.flac', '.m4a', '.wma', '.ogg'}
+
+
+def frame_levels(af, frame_ms=50, block_seconds=60):
+    """RMS level in dBFS of each frame_ms frame of a recording, streamed block by block.
+
+    Only one block of samples is in memory at a time; the result holds 4 bytes per frame
+    (under 1MB for a 3 hour side at 50ms)."""
+    levels = []
+    carry = np.empty(0, dtype=np.float32)
+    frame_len = None
+    for sr, block in stream_audio_blocks(af, block_seconds=block_seconds):
+        if frame_len is None:
+            frame_len = max(1, int(sr * frame_ms / 1000))
+        if carry.size:
+            block = np.concatenate((carry, block))
+        full = block.size - block.size % frame_len
+        frames = block[:full].reshape(-1, frame_len)
+        levels.append(np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1)).astype(np.float32))
+        carry = block[full:]
+    if carry.size:
+        levels.append(np.sqrt(np.mean(np.square(carry, dtype=np.float64), keepdims=True)).astype(np.float32))
+    if not levels:
+        return np.empty(0, dtype=np.float32)
+    rms = np.concatenate(levels)
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+
+def silence_runs(levels, frame_ms=50, threshold_db=None, margin_db=10, min_silence_ms=1500):
+    """(start_ms, end_ms) of the runs of frames quieter than the threshold.
+
+    Without an explicit threshold, silence is anything within margin_db of the noise floor
+    (5th percentile of the frame levels), which follows the hiss of each cassette, but always
+    margin_db below the median level so that a side with hardly any pause is not all silence."""
+    if not levels.size:
+        return []
+    if threshold_db is None:
+        threshold_db = min(np.percentile(levels, 5) + margin_db, np.median(levels) - margin_db)
+    silent = np.concatenate(([False], levels < threshold_db, [False]))
+    edges = np.flatnonzero(np.diff(silent.astype(np.int8)))
+    starts, ends = edges[::2], edges[1::2]
+    keep = (ends - starts) * frame_ms >= min_silence_ms
+    return [(int(s) * frame_ms, int(e) * frame_ms) for s, e in zip(starts[keep], ends[keep])]
+
+
+def candidate_sessions(silences, total_ms, min_session_ms=5 * 60 * 1000):
+    """Cut a recording in the middle of its longest silences, keeping sessions at least min_session_ms long"""
+    # longest silences first: they are the likeliest breaks between sessions
+    cuts = []
+    for start, end in sorted(silences, key=lambda r: r[0] - r[1]):
+        cut = (start + end) // 2
+        if cut < min_session_ms or total_ms - cut < min_session_ms:
+            continue
+        if all(abs(cut - c) >= min_session_ms for c, _ in cuts):
+            cuts.append((cut, end - start))
+    cuts.sort()
+    bounds = [0] + [c for c, _ in cuts] + [total_ms]
+    silence_before = [0] + [length for _, length in cuts]
+    return [(bounds[i], bounds[i + 1], silence_before[i]) for i in range(len(bounds) - 1)]
+
+
+def analyse_source(audio_path, folder, filename, frame_ms=50, threshold_db=None, min_silence_ms=1500,
+                   min_session_ms=5 * 60 * 1000):
+    """Candidate catalog rows for one source recording"""
+    levels = frame_levels(Path(audio_path) / folder / filename, frame_ms=frame_ms)
+    total_ms = levels.size * frame_ms
+    silences = silence_runs(levels, frame_ms=frame_ms, threshold_db=threshold_db, min_silence_ms=min_silence_ms)
+    rows = []
+    for start, end, silence in candidate_sessions(silences, total_ms, min_session_ms=min_session_ms):
+        row = dict.fromkeys(CANDIDATE_COLUMNS, '')
+        row.update({
+            'Folder': folder,
+            'filename': filename,
+            'start': to_timecode(start),
+            'end': to_timecode(end),
+            'duration': to_timecode(end - start),
+            'notes': f'auto: after {silence / 1000:.1f}s of silence' if silence else 'auto',
+        })
+        rows.append(row)
+    return rows
+
+
+def list_sources(audio_path, folders=None, skip_catalog=None):
+    """(Folder, filename) of the source recordings, leaving out those already timecoded in skip_catalog"""
+    audio_path = Path(audio_path)
+    done = set()
+    if skip_catalog:
+        done = {(row['Folder'], row['filename']) for row in load_catalog(skip_catalog) if row['start'] is not None}
+    sources = []
+    for folder in folders or sorted(d.name for d in audio_path.iterdir() if d.is_dir()):
+        for f in sorted((audio_path / folder).rglob('*')):
+            if f.suffix.lower() not in _AUDIO_SUFFIXES or f.name.startswith('.') or f.stem.endswith('_pcm16'):
+                continue
+            filename = str(f.relative_to(audio_path / folder))
+            if (folder, filename) not in done:
+                sources.append((folder, filename))
+    return sources
+
+
+def detect_boundaries(audio_path, out_tsv, folders=None, skip_catalog=None, max_workers=4, **params):
+    """Write candidate session boundaries for the source recordings as a catalog TSV to be confirmed by hand"""
+    sources = list_sources(audio_path, folders=folders, skip_catalog=skip_catalog)
+    print(f"Analysing {len(sources)} recordings using {max_workers} workers...")
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_source = {executor.submit(analyse_source, audio_path, folder, filename, **params): (folder, filename)
+                            for folder, filename in sources}
+        for completed, future in enumerate(concurrent.futures.as_completed(future_to_source), 1):
+            folder, filename = future_to_source[future]
+            try:
+                results[(folder, filename)] = future.result()
+                print(f"  [{completed}/{len(sources)}] {folder}/{filename}: {len(results[(folder, filename)])} sessions")
+            except Exception as e:
+                print(f"  [{completed}/{len(sources)}] ✗ {folder}/{filename}: {e}")
+
+    out_tsv = Path(out_tsv)
+    out_tsv.parent.mkdir(parents=True, exist_ok=True)
+    with open(out_tsv, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=CANDIDATE_COLUMNS, delimiter='\t', quotechar='|')
+        writer.writeheader()
+        for source in sources:
+            for row in results.get(source, []):
+                writer.writerow(row)
+    return results
@@ -0,0 +1,191 @@
+import csv
+import hashlib
+import pickle
+import sys
+from array import array
+from datetime import time
+from pathlib import Path
+
+# columns holding ISO timecodes, kept as integer milliseconds
+_TIMECODES = ('start', 'end', 'duration')
+# columns whose values repeat across many rows
+_INTERNED = ('Folder', 'export folder', 'session export status', 'filename', 'text title', 'author')
+_NO_TIME = -1
+
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_SUFFIX = '.snapshot'
+
+
+def to_milliseconds(timecode):
+    """Convert an ISO timecode ('HH:MM:SS.fff') to integer milliseconds"""
+    tm = time.fromisoformat(timecode)
+    return (tm.hour * 3600 + tm.minute * 60 + tm.second) * 1000 + tm.microsecond // 1000
+
+
+def to_timecode(millis):
+    """Convert integer milliseconds to an ISO timecode ('HH:MM:SS.fff')"""
+    seconds, ms = divmod(int(millis), 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:02d}:{minutes:02d}:{seconds:02d}.{ms:03d}'
+
+
+class CatalogRow:
+    """Lightweight view on one row of a Catalog, accessed like the csv.DictReader dicts it replaces"""
+    __slots__ = ('catalog', 'index')
+
+    def __init__(self, catalog, index):
+        self.catalog = catalog
+        self.index = index
+
+    def __getitem__(self, column):
+        cat = self.catalog
+        if column in cat.timecodes:
+            value = cat.timecodes[column][self.index]
+            return None if value == _NO_TIME else value
+        return cat.cells[self.index][cat.column_index[column]]
+
+    def __setitem__(self, column, value):
+        cat = self.catalog
+        if column in cat.timecodes:
+            cat.timecodes[column][self.index] = _NO_TIME if value is None else int(value)
+            return
+        cells = list(cat.cells[self.index])
+        cells[cat.column_index[column]] = value
+        cat.cells[self.index] = tuple(cells)
+
+    def __contains__(self, column):
+        return column in self.catalog.column_index
+
+    def get(self, column, default=None):
+        return self[column] if column in self else default
+
+    def keys(self):
+        return list(self.catalog.columns)
+
+    def items(self):
+        return [(c, self[c]) for c in self.catalog.columns]
+
+    def __eq__(self, other):
+        return isinstance(other, CatalogRow) and self.catalog is other.catalog and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.catalog), self.index))
+
+    def __repr__(self):
+        return f'CatalogRow({dict(self.items())!r})'
+
+
+class Catalog:
+    """Column-compact sessions catalog: timecodes in int64 arrays, other cells as tuples of interned strings"""
+    __slots__ = ('digest', 'columns', 'column_index', 'cells', 'timecodes')
+
+    def __init__(self, columns, digest=''):
+        self.digest = digest
+        self.columns = tuple(columns)
+        # timecode columns are served from the arrays, their cells stay empty
+        self.column_index = {c: i for i, c in enumerate(self.columns)}
+        self.cells = []
+        self.timecodes = {c: array('q') for c in _TIMECODES if c in self.column_index}
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __iter__(self):
+        for i in range(len(self.cells)):
+            yield CatalogRow(self, i)
+
+    def __getitem__(self, index):
+        if not -len(self.cells) <= index < len(self.cells):
+            raise IndexError(index)
+        return CatalogRow(self, index % len(self.cells))
+
+    def append(self, values):
+        cells = []
+        for column, value in zip(self.columns, values):
+            if column in self.timecodes:
+                self.timecodes[column].append(to_milliseconds(value) if value else _NO_TIME)
+                value = ''
+            elif column in _INTERNED:
+                value = sys.intern(value)
+            cells.append(value)
+        self.cells.append(tuple(cells))
+
+    def __getstate__(self):
+        return self.digest, self.columns, self.cells, {c: a.tobytes() for c, a in self.timecodes.items()}
+
+    def __setstate__(self, state):
+        digest, columns, cells, timecodes = state
+        self.digest = digest
+        self.columns = columns
+        self.column_index = {c: i for i, c in enumerate(columns)}
+        # repeated strings were pickled once and come back shared
+        self.cells = cells
+        self.timecodes = {}
+        for c, raw in timecodes.items():
+            self.timecodes[c] = array('q')
+            self.timecodes[c].frombytes(raw)
+
+
+def read_catalog_tsv(catalog, digest=''):
+    """Parse a sessions TSV into a Catalog without touching the snapshot cache"""
+    with open(catalog, newline='') as csvfile:
+        reader = csv.reader(csvfile, delimiter='\t', quotechar='|')
+        header = next(reader, [])
+        cat = Catalog(header, digest=digest)
+        width = len(header)
+        for values in reader:
+            if not values:
+                continue
+            if len(values) < width:
+                values = values + [''] * (width - len(values))
+            cat.append(values)
+    return cat
+
+
+def catalog_digest(catalog):
+    h = hashlib.blake2b(digest_size=16)
+    with open(catalog, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def snapshot_path(catalog):
+    catalog = Path(catalog)
+    return catalog.with_name(catalog.name + _SNAPSHOT_SUFFIX)
+
+
+def load_catalog(catalog, use_snapshot=True):
+    """Load a sessions TSV, going through a binary snapshot keyed by the TSV's content hash"""
+    catalog = Path(catalog)
+    digest = catalog_digest(catalog)
+    if not use_snapshot:
+        return read_catalog_tsv(catalog, digest)
+
+    snapshot = snapshot_path(catalog)
+    if snapshot.is_file():
+        try:
+            with open(snapshot, 'rb') as f:
+                version, snap_digest = pickle.load(f)
+                if version == _SNAPSHOT_VERSION and snap_digest == digest:
+                    return pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, ValueError, TypeError, AttributeError):
+            pass  # stale or corrupt snapshot: rebuild it below
+
+    cat = read_catalog_tsv(catalog, digest)
+    save_snapshot(cat, snapshot)
+    return cat
+
+
+def save_snapshot(cat, snapshot):
+    tmp = snapshot.with_name(snapshot.name + '.tmp')
+    try:
+        with open(tmp, 'wb') as f:
+            pickle.dump((_SNAPSHOT_VERSION, cat.digest), f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(cat, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp.replace(snapshot)
+    except (OSError, pickle.PicklingError) as e:
+        # a read-only input folder only costs us the cache
+        tmp.unlink(missing_ok=True)
+        print(f'Could not write catalog snapshot {snapshot}: {e}')
@@ -0,0 +1,260 @@
+import re
+from pathlib import Path
+
+from .chunk_recordings import (parse_catalog, keep_sessions_with_export_name, session_outputs, session_tags,
+                               check_session_needs_export, export_sessions, export_final_sessions, errors)
+from .publish import publish_files, remove_stale_outputs, prune_empty_dirs
+from .renditions import link_pairs, rendition_files
+from .retag import retag_sessions
+from .alignment import move_aligned_exports
+from .loudness import move_loudness_entries
+
+ADDED, REMOVED, RETIMED, RENAMED, RESTATUSED = 'added', 'removed', 'retimed', 'renamed', 'restatused'
+RETAGGED = 'retagged'
+_RENAMED_ONLY = re.compile(r'a\d+')
+
+
+def session_key(audio_file, s_name, s):
+    """Identity of a session across two versions of the catalog"""
+    # parse_catalog numbers renamed-only sessions with a running counter ("a12"), which shifts
+    # whenever a row is added above them: anchor them on their first timecode instead, or on their
+    # export name when they have none (whole side exports)
+    if _RENAMED_ONLY.fullmatch(s_name):
+        start = s[0][1]['start']
+        if start is None:
+            folder, filename = _name(s)
+            return audio_file, f"={folder}/{filename}"
+        return audio_file, f"@{start}"
+    return audio_file, s_name
+
+
+def _timing(s):
+    # not the part numbers: those of renamed-only sessions are their shifting "a12" names
+    return tuple((p['start'], p.get('end'), p['duration']) for _, p in s)
+
+
+def _name(s):
+    return s[0][1]['export folder'], s[0][1]['export filename']
+
+
+def _status(s):
+    return s[0][1]['session export status']
+
+
+class SessionChange:
+    """A session present in at least one of the two catalogs, with what changed about it"""
+    __slots__ = ('key', 'audio_file', 'kinds', 'old_name', 'old', 'new_name', 'new')
+
+    def __init__(self, key, audio_file, kinds, old_name=None, old=None, new_name=None, new=None):
+        self.key = key
+        self.audio_file = audio_file
+        self.kinds = kinds
+        self.old_name, self.old = old_name, old
+        self.new_name, self.new = new_name, new
+
+    def __repr__(self):
+        return f"SessionChange({self.key!r}, {sorted(self.kinds)})"
+
+
+class CatalogDiff:
+    """Sessions that differ between two parsed catalogs, by kind of change"""
+    __slots__ = ('changes',)
+
+    def __init__(self, changes):
+        self.changes = changes
+
+    def __bool__(self):
+        return bool(self.changes)
+
+    def __len__(self):
+        return len(self.changes)
+
+    def of_kind(self, kind):
+        return [c for c in self.changes if kind in c.kinds]
+
+    @property
+    def added(self):
+        return self.of_kind(ADDED)
+
+    @property
+    def removed(self):
+        return self.of_kind(REMOVED)
+
+    @property
+    def retimed(self):
+        return self.of_kind(RETIMED)
+
+    @property
+    def renamed(self):
+        return self.of_kind(RENAMED)
+
+    @property
+    def restatused(self):
+        return self.of_kind(RESTATUSED)
+
+    @property
+    def retagged(self):
+        return self.of_kind(RETAGGED)
+
+    @property
+    def moved(self):
+        """Sessions whose audio is unchanged but whose outputs live somewhere else now"""
+        return [c for c in self.changes if c.kinds & {RENAMED, RESTATUSED} and not c.kinds & {RETIMED, ADDED, REMOVED}]
+
+    def affected_files(self):
+        return {c.audio_file for c in self.changes}
+
+    def summary(self):
+        return {kind: len(self.of_kind(kind)) for kind in (ADDED, REMOVED, RETIMED, RENAMED, RESTATUSED, RETAGGED)}
+
+
+def index_sessions(catalog_sessions):
+    index = {}
+    for audio_file, sessions in catalog_sessions.items():
+        for s_name, s in sessions.items():
+            index[session_key(audio_file, s_name, s)] = (audio_file, s_name, s)
+    return index
+
+
+def diff_sessions(old_sessions, new_sessions):
+    """Compare two {audio_file: {session: parts}} mappings as returned by parse_catalog"""
+    old_index, new_index = index_sessions(old_sessions), index_sessions(new_sessions)
+    changes = []
+    for key, (audio_file, s_name, s) in new_index.items():
+        if key not in old_index:
+            changes.append(SessionChange(key, audio_file, {ADDED}, new_name=s_name, new=s))
+            continue
+        _, old_name, old = old_index[key]
+        kinds = set()
+        if _timing(old) != _timing(s):
+            kinds.add(RETIMED)
+        if _name(old) != _name(s):
+            kinds.add(RENAMED)
+        if _status(old) != _status(s):
+            kinds.add(RESTATUSED)
+        if session_tags(old) != session_tags(s):
+            kinds.add(RETAGGED)
+        if kinds:
+            changes.append(SessionChange(key, audio_file, kinds, old_name, old, s_name, s))
+    for key, (audio_file, s_name, s) in old_index.items():
+        if key not in new_index:
+            changes.append(SessionChange(key, audio_file, {REMOVED}, old_name=s_name, old=s))
+    return CatalogDiff(changes)
+
+
+def parse_sessions(catalog, final_filename):
+    """Sessions of a catalog as the exporter of the given layout sees them"""
+    if catalog is None or not Path(catalog).is_file():
+        return {}
+    _, catalog_sessions = parse_catalog(catalog, renamed_export=final_filename)
+    if final_filename:
+        catalog_sessions = keep_sessions_with_export_name(catalog_sessions)
+    return catalog_sessions
+
+
+def diff_catalogs(old_catalog, new_catalog, final_filename=False):
+    """Diff two sessions TSVs. A missing old catalog counts as empty: everything is added"""
+    return diff_sessions(parse_sessions(old_catalog, final_filename),
+                         parse_sessions(new_catalog, final_filename))
+
+
+def output_moves(change, out_path, final_filename):
+    """(old, new) output paths of a renamed or re-statused session that can be moved instead of exported again"""
+    old = session_outputs(change.audio_file, change.old_name, change.old, out_path, final_filename,
+                          peaks=True, streaming=True)
+    new = session_outputs(change.audio_file, change.new_name, change.new, out_path, final_filename,
+                          peaks=True, streaming=True)
+    # HLS playlists move along with their segments
+    return link_pairs([(src, dst) for src, dst in zip(old, new) if src != dst and src.is_file() and not dst.is_file()])
+
+
+def stale_outputs(change, out_path, final_filename):
+    return rendition_files(session_outputs(change.audio_file, change.old_name, change.old, out_path, final_filename,
+                                           peaks=True, streaming=True))
+
+
+def apply_file_changes(diff, out_path, final_filename, prune=True, max_workers=4):
+    """Move the outputs of renamed/re-statused sessions and delete the stale ones. Returns the moved changes"""
+    # 1. renames and status changes are filesystem moves
+    to_move = diff.moved
+    moves = [pair for change in to_move for pair in output_moves(change, out_path, final_filename)]
+    moved, failed = publish_files(moves, max_workers=max_workers, move=True)
+    for src, dst, e in failed:
+        errors.append(f"Error moving {src} to {dst}: {e}")
+    # the manifests are keyed by output path: a moved output keeps its alignment stamp and loudness
+    done = [(src, dst) for src, dst in moves if dst.is_file() and not src.is_file()]
+    move_aligned_exports(out_path, done)
+    move_loudness_entries(out_path, done)
+    # old folders left empty by the moves
+    prune_empty_dirs([src.parent for src, _ in moves], out_path)
+    print(f"  - Files moved: {moved}")
+
+    # 2. outputs cut with old timecodes or for removed sessions are stale
+    stale = []
+    for change in diff.changes:
+        if RETIMED in change.kinds or (prune and REMOVED in change.kinds):
+            stale.extend(stale_outputs(change, out_path, final_filename))
+    print(f"  - Stale files removed: {remove_stale_outputs(stale, out_path)}")
+
+    # 3. a new title, author or starting point is a tag rewrite, the audio stays (re-exported sessions are
+    # tagged when encoded)
+    retag = [(c.audio_file, c.new_name, c.new) for c in diff.retagged if not c.kinds & {ADDED, RETIMED}]
+    if retag:
+        retag_sessions(retag, out_path, final_filename, max_workers=max_workers)
+    return to_move
+
+
+def changes_to_export(diff, moved, out_path, final_filename, peaks=False, streaming=False):
+    """New and retimed sessions, plus moved ones that had never been exported"""
+    return [change for change in diff.changes
+            if change.kinds & {ADDED, RETIMED} or (change in moved and check_session_needs_export(
+                change.audio_file, change.new_name, change.new, out_path, final_filename, peaks=peaks,
+                streaming=streaming))]
+
+
+def apply_catalog_diff(diff, audio_path, out_path, pass_missing=False, final_filename=False,
+                       prune=True, batch_size=10, max_workers=4, peaks=False, streaming=False, loudness=None):
+    """Bring out_path in line with the new catalog, acting only on the sessions in diff"""
+    out_path = Path(out_path)
+    print(f"Catalog changes: {diff.summary()}")
+    moved = apply_file_changes(diff, out_path, final_filename, prune=prune, max_workers=max_workers)
+
+    # 3. only the sessions left need their audio
+    to_export = {}
+    for change in changes_to_export(diff, moved, out_path, final_filename, peaks=peaks, streaming=streaming):
+        to_export.setdefault(change.audio_file, {})[change.new_name] = change.new
+    if not to_export:
+        print("\nNo session needs to be exported.")
+        return
+
+    export = export_final_sessions if final_filename else export_sessions
+    export(to_export, audio_path, out_path,
+           pass_missing=pass_missing,
+           final_filename=final_filename,
+           batch_size=batch_size,
+           max_workers=max_workers,
+           peaks=peaks,
+           streaming=streaming,
+           loudness=loudness)
+
+
+def export_catalog_delta(old_catalog, new_catalog, audio_path, out_path, pass_missing=False,
+                         final_filename=True, prune=True, batch_size=10, max_workers=10, peaks=False,
+                         streaming=False, loudness=None):
+    """Export only what changed between the previously processed catalog and the new one"""
+    diff = diff_catalogs(old_catalog, new_catalog, final_filename=final_filename)
+    apply_catalog_diff(diff, audio_path, out_path,
+                       pass_missing=pass_missing,
+                       final_filename=final_filename,
+                       prune=prune,
+                       batch_size=batch_size,
+                       max_workers=max_workers,
+                       peaks=peaks,
+                       streaming=streaming,
+                       loudness=loudness)
+    print('-'*80)
+    print('Errors:')
+    for e in errors:
+        print(e)
+    print('-'*80)
+    return diff
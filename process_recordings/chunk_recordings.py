@@ -1,15 +1,24 @@
-import csv
-from datetime import time
 from collections import defaultdict
 from pathlib import Path
-from shutil import copy
 import concurrent.futures
 from functools import partial
 
+import soundfile as sf
 from pydub import AudioSegment
 from pydub.exceptions import CouldntDecodeError
 from soundfile import LibsndfileError
 
+from .catalog import load_catalog
+from .publish import publish_files, remove_stale_outputs
+from .renditions import (ENCODINGS, plan_renditions, link_pairs, rendition_files, streaming_paths,
+                         encode_rendition, part_ranges)
+from .peaks import peaks_paths, export_peaks
+from .supervisor import run_supervised
+from .alignment import resolve_alignment, record_aligned_export, load_aligned_exports, alignment_signature
+from .tags import write_tags
+from .loudness import (measure_loudness, normalization_gain, replaygain_tags, record_loudness, load_loudness_manifest,
+                       loudness_level, recorded_level, recorded_gain, write_mp4_replaygain)
+
 _COPYRIGHT = "Copyright © Shechen Archives. All Rights Reserved."
 _PROJECT_NAME = "Khyentse Önang"
 _DESCRIPTION = "Preserved by the Khyentse Önang Project. Original media from Shechen Archives."
@@ -19,37 +28,25 @@ _METADATA_TAGS = {
     "album": _PROJECT_NAME,
     "comment": _DESCRIPTION,
 }
+# per-session tags, from the catalog columns
+_SESSION_TAG_COLUMNS = {
+    "title": "text title",
+    "artist": "author",
+    "description": "starting from:",
+}
 
 errors = []
 
 
 def parse_catalog(catalog, renamed_export=False):
-    def to_milliseconds(tm):
-        millis = int((tm.hour * 3600) + (tm.minute * 60) + tm.second) * 1000 + (tm.microsecond / 1000)
-        return millis
-
     parsed = defaultdict(list)
-    # initial parse + reformat timecodes to ms
-    with open(catalog, newline='') as csvfile:
-        cat = csv.DictReader(csvfile, delimiter='\t', quotechar='|')
-        for row in cat:
-            if '.' not in row['filename']:
-                continue
-            file = row['filename'][:row['filename'].rfind('.')]
-            file = f"{row['Folder']}/{file}"
-            if row['start']:
-                row['start'] = to_milliseconds(time.fromisoformat(row['start']))
-            else:
-                row['start'] = None
-            if row['end']:
-                row['end'] = to_milliseconds(time.fromisoformat(row['end']))
-            else:
-                row['end'] = None
-            if row['duration']:
-                row['duration'] = to_milliseconds(time.fromisoformat(row['duration']))
-            else:
-                row['duration'] = None
-            parsed[file].append(row)
+    # initial parse: timecodes come as ms from the catalog model
+    for row in load_catalog(catalog):
+        if '.' not in row['filename']:
+            continue
+        file = row['filename'][:row['filename'].rfind('.')]
+        file = f"{row['Folder']}/{file}"
+        parsed[file].append(row)
 
     # group in teaching sessions
     def is_processed(parts, renamed_export=False):
@@ -118,6 +115,21 @@ def parse_catalog(catalog, renamed_export=False):
     return parsed, processed_in_sessions
 
 
+def session_tags(s):
+    """Tags of the outputs of a session: the project's, plus its text, author and starting point"""
+    tags = dict(_METADATA_TAGS)
+    for tag, column in _SESSION_TAG_COLUMNS.items():
+        value = (s[0][1].get(column) or '').strip()
+        if value:
+            tags[tag] = value
+    return tags
+
+
+def managed_tags():
+    """Names of the tags the exporter writes (and retag_outputs rewrites)"""
+    return tuple(_METADATA_TAGS) + tuple(_SESSION_TAG_COLUMNS)
+
+
 def gen_outpaths(audio_file, s_name, s, out_path, final_filename):
     ext = s[0][1]['filename'][s[0][1]['filename'].rfind('.') + 1:]
     if "ཧྥ་རན་སི" in str(final_filename):
@@ -141,16 +153,51 @@ def gen_outpaths(audio_file, s_name, s, out_path, final_filename):
     return out_file, out_file_compressed
 
 
-def check_session_needs_export(audio_file, s_name, s, out_path, final_filename, debug=False):
+def session_outputs(audio_file, s_name, s, out_path, final_filename, peaks=False, streaming=False):
+    """Paths of the files actually written for a session: wav, compressed, then the optional peak files
+    and streaming renditions"""
+    out_file, out_file_compressed = gen_outpaths(audio_file, s_name, s, out_path, final_filename)
+    # sessions cut from mp3 sources are saved as wav in the WAV folder
+    if out_file.suffix == '.mp3':
+        out_file = out_file.with_suffix('.wav')
+    outputs = [out_file, out_file_compressed]
+    if peaks:
+        # the dashboard previews the compressed files
+        outputs += peaks_paths(out_file_compressed)
+    outputs += [path for _, path in streaming_paths(out_file_compressed, out_path, final_filename, streaming)]
+    return outputs
+
+
+def check_session_needs_export(audio_file, s_name, s, out_path, final_filename, debug=False, peaks=False,
+                               streaming=False):
     """Check if a session needs to be exported without loading audio"""
     # Prepare output paths
-    out_file, out_file_compressed = gen_outpaths(audio_file, s_name, s, out_path, final_filename)
+    outputs = session_outputs(audio_file, s_name, s, out_path, final_filename, peaks=peaks, streaming=streaming)
     if debug:
-        print(len(str(out_file)), out_file)
-        print(len(str(out_file)), out_file_compressed)
+        for out in outputs:
+            print(len(str(out)), out)
+
+    # Return True if any file is missing
+    return not all(out.is_file() for out in outputs)
+
 
-    # Return True if either file is missing
-    return not (out_file.is_file() and out_file_compressed.is_file())
+def remove_misaligned_outputs(catalog, out_path, final_filename, alignment):
+    """Delete the outputs of the sessions cut with another alignment than the current one (or none), so that
+    they are exported again and never linked to the sessions sharing their audio"""
+    exported = load_aligned_exports(out_path)
+    if not alignment and not any(exported.values()):
+        return 0
+    stale = []
+    for audio_file, sessions in catalog.items():
+        signature = alignment_signature(alignment.get(audio_file) if alignment else None)
+        for s_name, s in sessions.items():
+            outputs = session_outputs(audio_file, s_name, s, out_path, final_filename, peaks=True, streaming=True)
+            if outputs[1].is_file() and exported.get(str(outputs[1].relative_to(out_path))) != signature:
+                stale.extend(rendition_files(outputs))
+    removed = remove_stale_outputs(stale, out_path)
+    if removed:
+        print(f"Removed {removed} files cut with another alignment, their sessions are exported again")
+    return removed
 
 
 def load_audio_file(audio_path, folder, filename, pass_missing):
@@ -170,19 +217,24 @@ def load_audio_file(audio_path, folder, filename, pass_missing):
         # Handle MS_ADPCM files
         new_af = af.parent / (af.stem + '_pcm16' + af.suffix)
         if not new_af.is_file():
-            import soundfile as sf
             try:
                 data, samplerate = sf.read(af)
             except LibsndfileError as e:
-                exit(e)
+                return None, f'Could not decode {af}: {e}'
             sf.write(new_af, data, samplerate, format='wav', subtype='PCM_16')
         audio = AudioSegment.from_file(new_af)
         return audio, None
 
 
-def export_single_session(task, audio_cache):
-    """Export a single session"""
+def export_single_session(task, audio_cache, peaks=False, streaming=False, alignment=None, loudness=None):
+    """Export a single session. alignment maps audio files to the SourceAlignment their catalog
+    timecodes are shifted by (restored sources timed with the catalog of the originals).
+
+    With loudness, the session is measured (integrated loudness, true peak, LRA) before encoding: True
+    only records it in the loudness manifest and as ReplayGain tags, a number (target LUFS) also applies
+    the gain reaching it to every output but the wav master"""
     audio_file, s_name, s, out_path, final_filename = task
+    aligned = alignment.get(audio_file) if alignment else None
 
     if audio_file not in audio_cache:
         return f"Skipped {audio_file} - audio not loaded"
@@ -190,45 +242,79 @@ def export_single_session(task, audio_cache):
     audio = audio_cache[audio_file]
 
     # Prepare output paths
-    out_file, out_file_compressed = gen_outpaths(audio_file, s_name, s, out_path, final_filename)
+    out_file, out_file_compressed = session_outputs(audio_file, s_name, s, out_path, final_filename)
 
-    # Build session audio
+    # Build session audio, from the same slices its rendition key is made of
+    ranges = part_ranges(s, final_filename, aligned)
+    if ranges is None:
+        errors.append(f"Error: Missing timecodes for {out_file.name}")
+        return f"Error: Missing timecodes for {out_file.name}"
     session_audio = AudioSegment.empty()
-    for part_num, part in s:
-        start, duration = part['start'], part['duration']
-        if not duration and final_filename:
+    for part in ranges:
+        if part == 'whole':
             session_audio += audio
-            break
-        elif not duration:
-            errors.append(f"Error: Missing timecodes for {out_file.name}")
-            return f"Error: Missing timecodes for {out_file.name}"
-        audio_part = audio[start:start + duration]
-        session_audio += audio_part
-
-    # Export both formats
+        else:
+            start, duration = part
+            session_audio += audio[start:start + duration]
+
+    # Export all formats, the streaming renditions in parallel encoders fed from the same session audio
+    renditions = [(r, path) for r, path in streaming_paths(out_file_compressed, out_path, final_filename, streaming)
+                  if not path.is_file()]
+    cut = not out_file_compressed.is_file()
     try:
-        if not out_file.is_file():
-            out_file.parent.mkdir(parents=True, exist_ok=True)
-            if out_file.suffix == '.mp3':
-                out_file = out_file.with_suffix('.wav')
-            session_audio.export(out_file, format="wav", tags=_METADATA_TAGS, parameters=[])
-        if not out_file_compressed.is_file():
-            out_file_compressed.parent.mkdir(parents=True, exist_ok=True)
-            if 'm4a' in out_file_compressed.suffix:
-                session_audio.export(out_file_compressed, format="ipod",
-                                     bitrate="256k",
-                                     parameters=["-q:a", "2"],
-                                     tags=_METADATA_TAGS)
-            elif 'mp3' in out_file_compressed.suffix:
-                session_audio.export(out_file_compressed, format="mp3", tags=_METADATA_TAGS)
+        # measured from the session already in memory: no second decode as with a two-pass loudnorm
+        delivered, tags, gain, replaygain = session_audio, session_tags(s), 0.0, {}
+        if loudness:
+            measured = measure_loudness(session_audio)
+            if not cut:
+                # renditions added next to an existing compressed output follow its level, not the target
+                gain = recorded_gain(out_path, out_file_compressed)
+            elif not isinstance(loudness, bool):
+                gain = normalization_gain(measured, loudness)
+            if gain:
+                measured = measured.with_gain(gain)
+                delivered = session_audio.apply_gain(gain)
+            replaygain = replaygain_tags(measured)
+        # the tags we manage are written with mutagen, like retag_outputs does, so that a fresh output
+        # already reads as retagged
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(renditions))) as encoders:
+            encoded = [encoders.submit(encode_rendition, delivered, r, path, tags, extra_tags=replaygain)
+                       for r, path in renditions]
+            if not out_file.is_file():
+                out_file.parent.mkdir(parents=True, exist_ok=True)
+                # masters keep the extension of their source: only ffmpeg tags those not named .wav
+                wav = out_file.suffix == '.wav'
+                session_audio.export(out_file, tags=None if wav else tags, **ENCODINGS['wav'])
+                if wav:
+                    write_tags(out_file, tags)
+            if not out_file_compressed.is_file():
+                out_file_compressed.parent.mkdir(parents=True, exist_ok=True)
+                if 'm4a' in out_file_compressed.suffix:
+                    delivered.export(out_file_compressed, **ENCODINGS['m4a'])
+                    write_tags(out_file_compressed, tags)
+                    write_mp4_replaygain(out_file_compressed, replaygain)
+                elif 'mp3' in out_file_compressed.suffix:
+                    delivered.export(out_file_compressed, tags=replaygain, **ENCODINGS['mp3'])
+                    write_tags(out_file_compressed, tags)
+            if peaks:
+                export_peaks(delivered, out_file_compressed)
+            for future in encoded:
+                future.result()
+        # outputs already there were measured when they were encoded
+        if cut and loudness:
+            record_loudness(out_path, out_file_compressed, audio_file, s_name, measured, gain,
+                            target=None if isinstance(loudness, bool) else loudness)
+        if cut:
+            record_aligned_export(out_path, out_file_compressed, aligned)
         return f"Exported: {out_file.stem}\n\t{out_file}\n\t{out_file_compressed}"
     except Exception as e:
         errors.append(f"Error exporting {out_file.name}: {str(e)}")
         return f"Error exporting {out_file.name}: {str(e)}"
 
 
-def process_batch(batch_info, audio_path, out_path, pass_missing, final_filename, max_workers):
-    """Process a batch of audio files"""
+def process_batch(batch_info, audio_path, out_path, pass_missing, final_filename, max_workers, peaks=False,
+                  streaming=False, strict=False, alignment=None, loudness=None):
+    """Process a batch of audio files. With strict, a source that can't be decoded raises instead of being logged"""
     batch_catalog, batch_num, total_batches = batch_info
 
     report = []
@@ -239,6 +325,7 @@ def process_batch(batch_info, audio_path, out_path, pass_missing, final_filename
     # Step 1: Check which files actually need processing
     report.append("\nChecking which sessions need export...")
     audio_files_needed = set()
+    all_tasks = []
     pending_tasks = []
     skipped_count = 0
 
@@ -246,9 +333,12 @@ def process_batch(batch_info, audio_path, out_path, pass_missing, final_filename
         needs_export = False
 
         for s_name, s in sessions.items():
-            if check_session_needs_export(audio_file, s_name, s, out_path, final_filename):
+            task = (audio_file, s_name, s, out_path, final_filename)
+            all_tasks.append(task)
+            if check_session_needs_export(audio_file, s_name, s, out_path, final_filename,
+                                          peaks=peaks, streaming=streaming):
                 needs_export = True
-                pending_tasks.append((audio_file, s_name, s, out_path, final_filename))
+                pending_tasks.append(task)
 
         if needs_export:
             audio_files_needed.add(audio_file)
@@ -298,6 +388,8 @@ def process_batch(batch_info, audio_path, out_path, pass_missing, final_filename
             audio_cache[audio_file] = audio
             print(f"  ✓ Loaded: {folder}/{filename}")
         elif error:
+            if strict and not error.startswith('File missing'):
+                raise RuntimeError(error)
             print(f"  ✗ {error}")
             errors.append(f"  ✗ {error}")
 
@@ -306,10 +398,40 @@ def process_batch(batch_info, audio_path, out_path, pass_missing, final_filename
         # Filter tasks to only include those with loaded audio
         valid_tasks = [task for task in pending_tasks if task[0] in audio_cache]
 
+        # Identical renditions (a translation session cut like its main session, a renamed session
+        # duplicating a numbered one...) are encoded once and linked to the other output paths
+        sources = {a: audio_path / folder / filename for a, (folder, filename) in audio_info.items() if a in audio_cache}
+        levels = load_loudness_manifest(out_path)
+
+        def variant_of(task, out, encoding):
+            """Tags and level of an output: as recorded for the existing ones and the ones added next to an
+            existing compressed output (see export_single_session), as this export encodes the others"""
+            compressed = session_outputs(*task)[1]
+            if out.is_file() or compressed.is_file():
+                level = recorded_level(levels.get(str(compressed.relative_to(out_path))))
+            else:
+                level = loudness_level(loudness)
+            if encoding.startswith('peaks'):
+                return level
+            tags = tuple(sorted(session_tags(task[2]).items()))
+            # the wav masters are neither normalized nor ReplayGain tagged
+            return tags if encoding == 'wav' else (tags, level)
+
+        plan = plan_renditions(all_tasks, valid_tasks, sources, lambda t: session_outputs(*t, peaks=peaks, streaming=streaming),
+                               variant_of=variant_of, alignment=alignment)
+        linked, failed = publish_files(link_pairs(plan.prelinks), max_workers=max_workers)
+        if plan.prelinks:
+            print(f"\nLinked {linked} outputs from identical renditions already exported")
+        deduplicated = len(valid_tasks) - len(plan.encode)
+        valid_tasks = plan.encode
+
         print(f"\nExporting {len(valid_tasks)} sessions using {max_workers} workers...")
+        if deduplicated:
+            print(f"  ({deduplicated} duplicate sessions will be linked instead of encoded)")
 
         with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            export_func = partial(export_single_session, audio_cache=audio_cache)
+            export_func = partial(export_single_session, audio_cache=audio_cache, peaks=peaks, streaming=streaming,
+                                  alignment=alignment, loudness=loudness)
 
             # Submit all tasks
             future_to_task = {executor.submit(export_func, task): task for task in valid_tasks}
@@ -324,6 +446,21 @@ def process_batch(batch_info, audio_path, out_path, pass_missing, final_filename
                     if result.startswith("Exported"):
                         successful += 1
 
+        # Link the duplicates to the renditions just encoded
+        links = link_pairs([(src, dst) for src, dst in plan.links if src.is_file()])
+        done, link_failed = publish_files(links, max_workers=max_workers)
+        for src, dst, e in failed + link_failed:
+            errors.append(f"Error linking {dst} to {src}: {e}")
+        if links:
+            print(f"Linked {done} duplicate outputs")
+        # linked outputs are cut like the rendition they share
+        encoded = {id(t) for t in plan.encode}
+        for task in pending_tasks:
+            if id(task) not in encoded and task[0] in audio_cache:
+                out_file_compressed = session_outputs(*task)[1]
+                if out_file_compressed.is_file():
+                    record_aligned_export(out_path, out_file_compressed, alignment.get(task[0]) if alignment else None)
+
         print(f"\nBatch complete: {successful} files exported")
 
     # Clear memory
@@ -331,14 +468,59 @@ def process_batch(batch_info, audio_path, out_path, pass_missing, final_filename
     return len(valid_tasks) if 'valid_tasks' in locals() else 0
 
 
+def _export_source(audio_file, sessions, audio_path, out_path, pass_missing, final_filename, max_workers,
+                   peaks, streaming, alignment, loudness):
+    """Worker process job: export the sessions of one source, handing the errors back to the supervisor"""
+    first_error = len(errors)
+    exported = process_batch(({audio_file: sessions}, 1, 1), audio_path, out_path, pass_missing, final_filename,
+                             max_workers, peaks=peaks, streaming=streaming, strict=True, alignment=alignment,
+                             loudness=loudness)
+    return exported, errors[first_error:]
+
+
+def export_isolated(catalog, audio_path, out_path, pass_missing, final_filename, max_workers, peaks=False,
+                    streaming=False, isolate=True, alignment=None, loudness=None):
+    """Export each source in a supervised worker process: a corrupt side or a hung ffmpeg is killed after its
+    timeout or memory limit, retried, then quarantined, while the other sources keep going.
+
+    isolate is True for the supervisor defaults, or a dict of run_supervised options
+    (processes, timeout, memory_limit, retries, quarantine)."""
+    options = dict(isolate) if isinstance(isolate, dict) else {}
+    options.setdefault('quarantine', out_path / '.quarantine.jsonl')
+    jobs = []
+    for audio_file, sessions in catalog.items():
+        if any(check_session_needs_export(audio_file, s_name, s, out_path, final_filename, peaks=peaks,
+                                          streaming=streaming) for s_name, s in sessions.items()):
+            jobs.append((audio_file, (audio_file, sessions, audio_path, out_path, pass_missing, final_filename,
+                                      max_workers, peaks, streaming, alignment, loudness)))
+    print(f"\nExporting {len(jobs)} audio files in isolated worker processes...")
+
+    def collect(audio_file, result):
+        exported, job_errors = result
+        errors.extend(job_errors)
+
+    results, failures = run_supervised(_export_source, jobs, on_result=collect, **options)
+    for audio_file, reason in failures.items():
+        errors.append(f"  ✗ {audio_file} quarantined: {reason}")
+    return sum(exported for exported, _ in results.values())
+
+
 def export_sessions(catalog, audio_path, out_path, pass_missing=False, single_file='',
-                    final_filename=False, batch_size=10, max_workers=4):
-    """Export sessions processing files in batches with pre-checking"""
+                    final_filename=False, batch_size=10, max_workers=4, peaks=False, streaming=False, isolate=None,
+                    alignment=None, loudness=None):
+    """Export sessions processing files in batches with pre-checking.
+
+    alignment is the offset/drift map applied to the timecodes (see align_sources): by default the one
+    saved in out_path, if any. loudness is passed to export_single_session"""
     out_path.mkdir(exist_ok=True, parents=True)
+    alignment = resolve_alignment(alignment, out_path)
+    if alignment:
+        print(f"Applying the alignment of {len(alignment)} restored recordings to the catalog timecodes")
 
     # Filter catalog if single_file is specified
     if single_file:
         catalog = {k: v for k, v in catalog.items() if k == single_file}
+    remove_misaligned_outputs(catalog, out_path, final_filename, alignment)
 
     # Quick scan to see how many files need processing
     print("Performing initial scan to check which files need export...")
@@ -348,7 +530,8 @@ def export_sessions(catalog, audio_path, out_path, pass_missing=False, single_fi
     for audio_file, sessions in catalog.items():
         needs_export = False
         for s_name, s in sessions.items():
-            if check_session_needs_export(audio_file, s_name, s, out_path, final_filename):
+            if check_session_needs_export(audio_file, s_name, s, out_path, final_filename,
+                                          peaks=peaks, streaming=streaming):
                 needs_export = True
                 break
 
@@ -381,10 +564,15 @@ def export_sessions(catalog, audio_path, out_path, pass_missing=False, single_fi
 
     # Process each batch
     total_exported = 0
-    for batch_num, batch in enumerate(batches, 1):
+    if isolate:
+        total_exported = export_isolated(catalog, audio_path, out_path, pass_missing, final_filename, max_workers,
+                                         peaks=peaks, streaming=streaming, isolate=isolate, alignment=alignment,
+                                         loudness=loudness)
+    for batch_num, batch in enumerate(batches if not isolate else [], 1):
         batch_info = (batch, batch_num, len(batches))
         exported = process_batch(batch_info, audio_path, out_path,
-                                 pass_missing, final_filename, max_workers)
+                                 pass_missing, final_filename, max_workers, peaks=peaks, streaming=streaming,
+                                 alignment=alignment, loudness=loudness)
         total_exported += exported
 
     print(f"\n{'=' * 60}")
@@ -392,13 +580,21 @@ def export_sessions(catalog, audio_path, out_path, pass_missing=False, single_fi
     print(f"{'=' * 60}")
 
 def export_final_sessions(catalog, audio_path, out_path, pass_missing=False, single_file='',
-                    final_filename=False, batch_size=10, max_workers=4):
-    """Export sessions processing files in batches with pre-checking"""
+                    final_filename=False, batch_size=10, max_workers=4, peaks=False, streaming=False, isolate=None,
+                    alignment=None, loudness=None):
+    """Export sessions processing files in batches with pre-checking.
+
+    alignment is the offset/drift map applied to the timecodes (see align_sources): by default the one
+    saved in out_path, if any. loudness is passed to export_single_session"""
     out_path.mkdir(exist_ok=True, parents=True)
+    alignment = resolve_alignment(alignment, out_path)
+    if alignment:
+        print(f"Applying the alignment of {len(alignment)} restored recordings to the catalog timecodes")
 
     # Filter catalog if single_file is specified
     if single_file:
         catalog = {k: v for k, v in catalog.items() if k == single_file}
+    remove_misaligned_outputs(catalog, out_path, final_filename, alignment)
 
     # Quick scan to see how many files need processing
     print("Performing initial scan to check which files need export...")
@@ -408,7 +604,8 @@ def export_final_sessions(catalog, audio_path, out_path, pass_missing=False, sin
     for audio_file, sessions in catalog.items():
         needs_export = False
         for s_name, s in sessions.items():
-            if check_session_needs_export(audio_file, s_name, s, out_path, final_filename):
+            if check_session_needs_export(audio_file, s_name, s, out_path, final_filename,
+                                          peaks=peaks, streaming=streaming):
                 needs_export = True
                 break
 
@@ -441,10 +638,15 @@ def export_final_sessions(catalog, audio_path, out_path, pass_missing=False, sin
 
     # Process each batch
     total_exported = 0
-    for batch_num, batch in enumerate(batches, 1):
+    if isolate:
+        total_exported = export_isolated(catalog, audio_path, out_path, pass_missing, final_filename, max_workers,
+                                         peaks=peaks, streaming=streaming, isolate=isolate, alignment=alignment,
+                                         loudness=loudness)
+    for batch_num, batch in enumerate(batches if not isolate else [], 1):
         batch_info = (batch, batch_num, len(batches))
         exported = process_batch(batch_info, audio_path, out_path,
-                                 pass_missing, final_filename, max_workers)
+                                 pass_missing, final_filename, max_workers, peaks=peaks, streaming=streaming,
+                                 alignment=alignment, loudness=loudness)
         total_exported += exported
 
     print(f"\n{'=' * 60}")
@@ -453,7 +655,8 @@ def export_final_sessions(catalog, audio_path, out_path, pass_missing=False, sin
 
 
 def export_teachings(catalog, audio_path, out_path, pass_missing=False,
-                     single_file='', batch_size=10, max_workers=10):
+                     single_file='', batch_size=10, max_workers=10, peaks=False, streaming=False, isolate=None,
+                     alignment=None, loudness=None):
     """Main export function with pre-checking and configurable batch size"""
     catalog, catalog_sessions = parse_catalog(catalog)
     export_sessions(catalog_sessions, audio_path, out_path,
@@ -461,7 +664,12 @@ def export_teachings(catalog, audio_path, out_path, pass_missing=False,
                     single_file=single_file,
                     final_filename=False,
                     batch_size=batch_size,
-                    max_workers=max_workers)
+                    max_workers=max_workers,
+                    peaks=peaks,
+                    streaming=streaming,
+                    isolate=isolate,
+                    alignment=alignment,
+                    loudness=loudness)
     print('-'*80)
     print('Errors:')
     for e in errors:
@@ -484,16 +692,15 @@ def keep_sessions_with_export_name(catalog_sessions):
 
 def find_renamed_sessions_dupes(catalog):
     parsed = defaultdict(int)
-    with open(catalog, newline='') as csvfile:
-        cat = csv.DictReader(csvfile, delimiter='\t', quotechar='|')
-        for row in cat:
-            renamed_session = f"{row['export folder']}/{row['export filename']}"
-            parsed[renamed_session] += 1
+    for row in load_catalog(catalog):
+        renamed_session = f"{row['export folder']}/{row['export filename']}"
+        parsed[renamed_session] += 1
     return parsed
 
 
 def export_renamed_sessions(catalog, audio_path, out_path, pass_missing=False,
-                     single_file='', batch_size=10, max_workers=10):
+                     single_file='', batch_size=10, max_workers=10, peaks=False, streaming=False, isolate=None,
+                     alignment=None, loudness=None):
     """export final sessions processing files in batches with pre-checking"""
     catalog, catalog_sessions = parse_catalog(catalog, renamed_export=True)
     catalog_sessions = keep_sessions_with_export_name(catalog_sessions)
@@ -502,16 +709,49 @@ def export_renamed_sessions(catalog, audio_path, out_path, pass_missing=False,
                     single_file=single_file,
                     final_filename=True,
                     batch_size=batch_size,
-                    max_workers=max_workers)
+                    max_workers=max_workers,
+                    peaks=peaks,
+                    streaming=streaming,
+                    isolate=isolate,
+                    alignment=alignment,
+                    loudness=loudness)
     print('-'*80)
     print('Errors:')
     for e in errors:
         print(e)
     print('-'*80)
 
-def export_final_files(catalog_path, mp3_path, srt_path, out):
-    catalog = parse_catalog(catalog_path)
+def find_stale_outputs(catalog_sessions, out_path, final_filename,
+                       suffixes=('.wav', '.mp3', '.m4a', '.dat', '.opus', '.m3u8')):
+    """Files under out_path that no session of the catalog exports to anymore (e.g. left behind by a status change)"""
+    expected = set()
+    for audio_file, sessions in catalog_sessions.items():
+        for s_name, s in sessions.items():
+            expected.update(session_outputs(audio_file, s_name, s, out_path, final_filename, peaks=True, streaming=True))
+    return rendition_files([f for f in Path(out_path).rglob('*')
+                            if f.suffix in suffixes and f.is_file() and f not in expected])
+
+
+def prune_stale_outputs(catalog, out_path, final_filename=True, remove=False):
+    """List the outputs no session of the catalog exports to anymore, and delete them with remove"""
+    out_path = Path(out_path)
+    _, catalog_sessions = parse_catalog(catalog, renamed_export=final_filename)
+    if final_filename:
+        catalog_sessions = keep_sessions_with_export_name(catalog_sessions)
+    stale = find_stale_outputs(catalog_sessions, out_path, final_filename)
+    print(f"\n{len(stale)} files in {out_path} are not exported by the catalog anymore:")
+    for path in stale:
+        print(f"  - {path.relative_to(out_path)}")
+    if remove and stale:
+        print(f"  - Stale files removed: {remove_stale_outputs(stale, out_path)}")
+    return stale
+
+
+def export_final_files(catalog_path, mp3_path, srt_path, out, prune=False, max_workers=8):
+    catalog, _ = parse_catalog(catalog_path)
     mp3, srt, out = Path(mp3_path), Path(srt_path), Path(out)
+    to_publish = []
+    published = set()
     for sessions in catalog.values():
         for s in sessions:
             new = s['filename_session']
@@ -519,11 +759,24 @@ def export_final_files(catalog_path, mp3_path, srt_path, out):
                 orig = s['filename']
                 mp3_orig = mp3 / (orig + '.mp3')
                 mp3_new = out / (new + '.mp3')
-                copy(mp3_orig, mp3_new)
+                to_publish.append((mp3_orig, mp3_new))
 
                 srt_orig = srt / (orig + '.srt')
                 srt_new = out / (new + '.srt')
-                copy(srt_orig, srt_new)
+                to_publish.append((srt_orig, srt_new))
 
                 title = out / (new + '.txt')
+                title.parent.mkdir(parents=True, exist_ok=True)
                 title.write_text(s['session_title'])
+                published.update((mp3_new, srt_new, title))
+
+    # hardlinks/reflinks where the filesystem allows it: publishing costs metadata, not a copy of the audio
+    done, failed = publish_files(to_publish, max_workers=max_workers)
+    print(f"Published {done} files to {out}")
+    for src, dst, e in failed:
+        errors.append(f"Error publishing {src} to {dst}: {e}")
+        print(f"  ✗ {src}: {e}")
+
+    if prune:
+        stale = [f for f in out.rglob('*') if f.suffix in ('.mp3', '.srt', '.txt') and f.is_file() and f not in published]
+        print(f"Removed {remove_stale_outputs(stale, out)} stale files from {out}")
@@ -0,0 +1,56 @@
+import subprocess
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+from pydub.utils import get_encoder_name, mediainfo
+from soundfile import LibsndfileError
+
+
+def _ffmpeg_blocks(af, samplerate, block_samples):
+    cmd = [get_encoder_name(), '-v', 'error', '-nostdin', '-i', str(af),
+           '-ac', '1', '-ar', str(samplerate), '-f', 'f32le', '-']
+    # stderr goes to a file: a pipe nobody reads would block ffmpeg once full
+    with tempfile.TemporaryFile() as log:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=log)
+        finished = False
+        try:
+            block_bytes = block_samples * 4
+            while True:
+                raw = proc.stdout.read(block_bytes)
+                if not raw:
+                    break
+                yield np.frombuffer(raw[:len(raw) - len(raw) % 4], dtype=np.float32)
+            finished = True
+        finally:
+            proc.stdout.close()
+            if not finished:  # the caller stopped early
+                proc.kill()
+            proc.wait()
+        if proc.returncode:
+            log.seek(0)
+            message = log.read().decode(errors='replace').strip()
+            raise RuntimeError(f'ffmpeg failed decoding {Path(af).name}: {message or proc.returncode}')
+
+
+def stream_audio_blocks(af, block_seconds=60, samplerate=None):
+    """Yield the audio of a file as (samplerate, mono float32 block) of block_seconds each.
+
+    Memory stays bounded to one block whatever the length of the recording. Files libsndfile can read
+    (including the MS_ADPCM sides pydub chokes on) are read directly, the rest is piped from ffmpeg,
+    which also resamples when a samplerate is asked for."""
+    af = Path(af)
+    if samplerate is None:
+        try:
+            f = sf.SoundFile(af)
+        except LibsndfileError:
+            samplerate = int(mediainfo(str(af)).get('sample_rate', 44100))
+        else:
+            with f:
+                sr = f.samplerate
+                for block in f.blocks(blocksize=int(sr * block_seconds), dtype='float32', always_2d=True):
+                    yield sr, block.mean(axis=1) if block.shape[1] > 1 else block[:, 0]
+            return
+    for block in _ffmpeg_blocks(af, samplerate, int(samplerate * block_seconds)):
+        yield samplerate, block
@@ -0,0 +1,224 @@
+import concurrent.futures
+import csv
+import os
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+
+from .boundaries import list_sources
+from .catalog import to_timecode
+from .decode import stream_audio_blocks
+
+# spectrograms of the sources resampled to 8kHz: speech is all below 4kHz
+FINGERPRINT_RATE = 8000
+N_FFT = 1024
+HOP = 512
+FRAME_MS = HOP * 1000 / FINGERPRINT_RATE
+# peaks are the loudest bin of each band that is also the loudest of that band over +/- PEAK_SPREAD frames
+BAND_EDGES_HZ = (250, 500, 800, 1200, 1800, 2600, 3800)
+PEAK_SPREAD = 8
+PEAK_MIN_DB = 6
+# each peak is hashed with the next FAN_OUT peaks found less than MAX_DT frames after it
+FAN_OUT = 3
+MAX_DT = 63
+# frequency bins are merged by two so that a slightly faster tape deck still gives the same hashes
+_BIN_SHIFT = 1
+# deltas between matching hashes are grouped by this many frames
+_DELTA_BIN = 4
+
+REPORT_COLUMNS = ['kind', 'source', 'other source', 'offset', 'source start', 'source end',
+                  'other start', 'other end', 'matches', 'coverage']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    frames INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS hashes (
+    hash INTEGER NOT NULL,
+    source INTEGER NOT NULL,
+    frame INTEGER NOT NULL,
+    PRIMARY KEY (hash, source, frame)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS hashes_source ON hashes (source);
+"""
+
+
+def _band_bins():
+    bins = np.round(np.array(BAND_EDGES_HZ) * N_FFT / FINGERPRINT_RATE).astype(int)
+    return list(zip(bins[:-1], bins[1:]))
+
+
+def spectral_peaks(af, block_seconds=60):
+    """(frame, bin) of the spectral peaks of a recording, and its length in frames.
+
+    The source is streamed at 8kHz mono one block at a time and each block goes through a single
+    vectorized STFT, so a side of any length costs a few MB."""
+    window = np.hanning(N_FFT).astype(np.float32)
+    bands = _band_bins()
+    carry = np.empty(0, dtype=np.float32)
+    peaks, first_frame = [], 0
+    for _, block in stream_audio_blocks(af, block_seconds=block_seconds, samplerate=FINGERPRINT_RATE):
+        block = np.concatenate((carry, block)) if carry.size else block
+        if block.size < N_FFT:
+            carry = block
+            continue
+        frames = np.lib.stride_tricks.sliding_window_view(block, N_FFT)[::HOP]
+        carry = block[len(frames) * HOP:]
+        spectrum = 20 * np.log10(np.abs(np.fft.rfft(frames * window, axis=1)) + 1e-9)
+        for low, high in bands:
+            band = spectrum[:, low:high]
+            best = band.argmax(axis=1)
+            level = band[np.arange(len(band)), best]
+            # the loudest of its neighbourhood in time, and standing out of the band's usual level
+            padded = np.pad(level, PEAK_SPREAD, constant_values=-np.inf)
+            local_max = np.lib.stride_tricks.sliding_window_view(padded, 2 * PEAK_SPREAD + 1).max(axis=1)
+            keep = np.flatnonzero((level == local_max) & (level > np.median(level) + PEAK_MIN_DB))
+            peaks.append(np.column_stack((keep + first_frame, best[keep] + low)))
+        first_frame += len(frames)
+    if not peaks:
+        return np.empty((0, 2), dtype=np.int64), first_frame
+    peaks = np.concatenate(peaks).astype(np.int64)
+    return peaks[np.lexsort((peaks[:, 1], peaks[:, 0]))], first_frame
+
+
+def peak_hashes(peaks):
+    """(hash, frame) of pairs of nearby peaks: both frequencies and their distance in time"""
+    if not len(peaks):
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = []
+    t, f = peaks[:, 0], peaks[:, 1] >> _BIN_SHIFT
+    for k in range(1, FAN_OUT + 1):
+        dt = t[k:] - t[:-k]
+        keep = (dt > 0) & (dt <= MAX_DT)
+        h = (f[:-k] << 14) | (f[k:] << 6) | dt
+        pairs.append(np.column_stack((h[keep], t[:-k][keep])))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def fingerprint_source(af):
+    peaks, frames = spectral_peaks(af)
+    return peak_hashes(peaks), frames
+
+
+def open_index(db):
+    db = Path(db)
+    db.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(db)
+    con.executescript(_SCHEMA)
+    return con
+
+
+def index_sources(audio_path, db, folders=None, max_workers=4):
+    """Fingerprint the source recordings into the SQLite index db, skipping those unchanged since they were indexed.
+
+    Returns the number of recordings (re)indexed."""
+    audio_path = Path(audio_path)
+    con = open_index(db)
+    known = {path: (size, mtime_ns) for path, size, mtime_ns in con.execute('SELECT path, size, mtime_ns FROM sources')}
+    to_index = {}
+    for folder, filename in list_sources(audio_path, folders=folders):
+        rel = f'{folder}/{filename}'
+        st = os.stat(audio_path / rel)
+        if known.get(rel) != (st.st_size, st.st_mtime_ns):
+            to_index[rel] = (st.st_size, st.st_mtime_ns)
+    print(f"Fingerprinting {len(to_index)} recordings using {max_workers} workers...")
+
+    indexed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_path = {executor.submit(fingerprint_source, audio_path / rel): rel for rel in to_index}
+        for completed, future in enumerate(concurrent.futures.as_completed(future_to_path), 1):
+            rel = future_to_path[future]
+            try:
+                hashes, frames = future.result()
+            except Exception as e:
+                print(f"  [{completed}/{len(to_index)}] ✗ {rel}: {e}")
+                continue
+            # a single writer: the workers only compute
+            with con:
+                row = con.execute('SELECT id FROM sources WHERE path = ?', (rel,)).fetchone()
+                if row:
+                    con.execute('DELETE FROM hashes WHERE source = ?', row)
+                    con.execute('DELETE FROM sources WHERE id = ?', row)
+                size, mtime_ns = to_index[rel]
+                source_id = con.execute('INSERT INTO sources (path, size, mtime_ns, frames) VALUES (?, ?, ?, ?)',
+                                        (rel, size, mtime_ns, frames)).lastrowid
+                con.executemany('INSERT OR IGNORE INTO hashes (hash, source, frame) VALUES (?, ?, ?)',
+                                ((int(h), source_id, int(t)) for h, t in hashes))
+            indexed += 1
+            print(f"  [{completed}/{len(to_index)}] {rel}: {len(hashes)} hashes")
+
+    # recordings deleted or moved since the last run
+    gone = [(path,) for path in known if not (audio_path / path).is_file()]
+    if gone:
+        with con:
+            con.executemany('DELETE FROM hashes WHERE source = (SELECT id FROM sources WHERE path = ?)', gone)
+            con.executemany('DELETE FROM sources WHERE path = ?', gone)
+    con.close()
+    return indexed
+
+
+def find_matches(con, source_id, min_matches=20):
+    """(other source, offset frames, matches, first frame, last frame) of the recordings sharing audio with
+    source_id at a consistent time offset: other frame = frame + offset"""
+    rows = con.execute(f"""
+        SELECT h2.source, (h2.frame - h1.frame) / {_DELTA_BIN} AS delta, COUNT(*), MIN(h1.frame), MAX(h1.frame),
+               AVG(h2.frame - h1.frame)
+        FROM hashes h1 JOIN hashes h2 ON h2.hash = h1.hash AND h2.source > h1.source
+        WHERE h1.source = ?
+        GROUP BY h2.source, delta
+        HAVING COUNT(*) >= ?""", (source_id, min_matches)).fetchall()
+    # one offset per pair: the best supported
+    best = {}
+    for other, _, count, first, last, offset in rows:
+        if other not in best or count > best[other][1]:
+            best[other] = (round(offset), count, first, last)
+    return [(other, *match) for other, match in best.items()]
+
+
+def _ms(frames):
+    return int(frames * FRAME_MS)
+
+
+def find_duplicates(db, report, min_matches=20, duplicate_coverage=0.9):
+    """Write a TSV of the pairs of recordings sharing audio, with the offset between them.
+
+    A pair is a duplicate when the shared stretch covers duplicate_coverage of both recordings,
+    otherwise an overlap (one side copied into another, the same talk recorded twice...)."""
+    con = open_index(db)
+    sources = {sid: (path, frames) for sid, path, frames in con.execute('SELECT id, path, frames FROM sources')}
+    print(f"Matching {len(sources)} fingerprinted recordings...")
+    results = []
+    for sid, (path, frames) in sources.items():
+        for other, offset, count, first, last in find_matches(con, sid, min_matches=min_matches):
+            other_path, other_frames = sources[other]
+            span = last - first + MAX_DT
+            coverage = min(span / max(frames, 1), span / max(other_frames, 1))
+            results.append({
+                'kind': 'duplicate' if coverage >= duplicate_coverage else 'overlap',
+                'source': path,
+                'other source': other_path,
+                'offset': ('-' if offset < 0 else '') + to_timecode(abs(_ms(offset))),
+                'source start': to_timecode(_ms(first)),
+                'source end': to_timecode(_ms(last + MAX_DT)),
+                'other start': to_timecode(_ms(max(0, first + offset))),
+                'other end': to_timecode(_ms(last + MAX_DT + offset)),
+                'matches': count,
+                'coverage': f'{coverage:.0%}',
+            })
+    con.close()
+
+    results.sort(key=lambda r: (r['kind'] != 'duplicate', r['source'], r['other source']))
+    report = Path(report)
+    report.parent.mkdir(parents=True, exist_ok=True)
+    with open(report, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=REPORT_COLUMNS, delimiter='\t')
+        writer.writeheader()
+        writer.writerows(results)
+    duplicates = sum(r['kind'] == 'duplicate' for r in results)
+    print(f"\nFound {duplicates} duplicates and {len(results) - duplicates} overlaps, see {report}")
+    return results
@@ -0,0 +1,260 @@
+import json
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from mutagen.mp4 import MP4, MP4FreeForm
+
+# ITU-R BS.1770-4 / EBU R128 measurement
+BLOCK_MS = 400
+HOP_MS = 100
+SHORT_TERM_MS = 3000
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+LRA_RELATIVE_GATE = -20.0
+TRUE_PEAK_OVERSAMPLING = 4
+# ReplayGain 2.0 reference level
+REPLAYGAIN_REFERENCE = -18.0
+
+# K-weighting: high shelf then high-pass (the BS.1770 filters, re-derived for any sample rate)
+_SHELF = (1681.974450955533, 3.999843853973347, 0.7071752369554196)
+_HIGH_PASS = (38.13547087602444, 0.5003270373238773)
+
+_MANIFEST_FILE = '.loudness.jsonl'
+_manifest_lock = threading.Lock()
+
+
+class Loudness:
+    """Integrated loudness (LUFS), true peak (dBTP) and loudness range (LU) of a session"""
+    __slots__ = ('integrated', 'true_peak', 'lra')
+
+    def __init__(self, integrated, true_peak, lra):
+        self.integrated = integrated
+        self.true_peak = true_peak
+        self.lra = lra
+
+    def with_gain(self, gain_db):
+        return Loudness(self.integrated + gain_db, self.true_peak + gain_db, self.lra)
+
+    def to_json(self):
+        return {'integrated_lufs': round(self.integrated, 2), 'true_peak_dbtp': round(self.true_peak, 2),
+                'lra_lu': round(self.lra, 2)}
+
+    def __repr__(self):
+        return f'Loudness({self.integrated:.1f} LUFS, {self.true_peak:.1f} dBTP, LRA {self.lra:.1f} LU)'
+
+
+def k_weighting_power(samplerate, n_fft):
+    """|H|² of the K-weighting filters at the bins of an rfft of n_fft samples"""
+    f0, gain_db, q = _SHELF
+    k = np.tan(np.pi * f0 / samplerate)
+    vh = 10 ** (gain_db / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf_b = np.array([vh + vb * k / q + k * k, 2 * (k * k - vh), vh - vb * k / q + k * k]) / a0
+    shelf_a = np.array([1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    f0, q = _HIGH_PASS
+    k = np.tan(np.pi * f0 / samplerate)
+    a0 = 1 + k / q + k * k
+    hp_b = np.array([1.0, -2.0, 1.0])
+    hp_a = np.array([1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+
+    z = np.exp(-2j * np.pi * np.arange(n_fft // 2 + 1) / n_fft)
+    zs = np.stack((np.ones_like(z), z, z * z))
+    response = (shelf_b @ zs) / (shelf_a @ zs) * (hp_b @ zs) / (hp_a @ zs)
+    return np.abs(response) ** 2
+
+
+def _frames(segment):
+    width = segment.sample_width
+    dtype = {1: np.uint8, 2: np.int16, 4: np.int32}[width]
+    frames = np.frombuffer(segment.raw_data, dtype=dtype).reshape(-1, segment.channels)
+    # 8 bit wav is unsigned
+    offset, full_scale = (128, 128.0) if width == 1 else (0, float(1 << (8 * width - 1)))
+    return frames, offset, full_scale
+
+
+def block_powers(segment, chunk_seconds=10, margin_ms=500):
+    """K-weighted mean square of each 400ms block (100ms apart), summed over the channels.
+
+    The weighting is applied in the frequency domain over chunks of the session (with margins absorbing
+    the filter's ringing), reading the PCM buffer directly so that no float copy of the whole session is
+    made. Blocks are then summed from the energy of 100ms sub-blocks, each sample being filtered once."""
+    frames, offset, full_scale = _frames(segment)
+    sr = segment.frame_rate
+    hop = sr * HOP_MS // 1000
+    per_block = BLOCK_MS // HOP_MS
+    chunk, margin = hop * (chunk_seconds * 1000 // HOP_MS), sr * margin_ms // 1000
+    responses = {}
+    energies = []
+    for start in range(0, len(frames) - len(frames) % hop, chunk):
+        end = min(start + chunk, len(frames) - len(frames) % hop)
+        lo, hi = max(0, start - margin), min(len(frames), end + margin)
+        x = (frames[lo:hi].astype(np.float32) - offset) / full_scale
+        n = _fft_size(len(x))
+        if n not in responses:
+            responses[n] = np.sqrt(k_weighting_power(sr, n))[:, None]
+        y = np.fft.irfft(np.fft.rfft(x, n, axis=0) * responses[n], n, axis=0)[start - lo:end - lo]
+        energies.append(np.square(y, dtype=np.float64).sum(axis=1).reshape(-1, hop).mean(axis=1))
+    if not energies:
+        return np.empty(0)
+    energies = np.concatenate(energies)
+    if len(energies) < per_block:
+        return np.empty(0)
+    csum = np.concatenate(([0], np.cumsum(energies)))
+    return (csum[per_block:] - csum[:-per_block]) / per_block
+
+
+def _fft_size(n):
+    return 1 << (n - 1).bit_length()
+
+
+def _loudness(power):
+    return -0.691 + 10 * np.log10(np.maximum(power, 1e-20))
+
+
+def integrated_loudness(powers):
+    """Gated integrated loudness of the block powers"""
+    levels = _loudness(powers)
+    gated = powers[levels > ABSOLUTE_GATE]
+    if not gated.size:
+        return -np.inf
+    threshold = _loudness(gated.mean()) + RELATIVE_GATE
+    gated = powers[(levels > ABSOLUTE_GATE) & (levels > threshold)]
+    return float(_loudness(gated.mean()))
+
+
+def loudness_range(powers):
+    """EBU Tech 3342 loudness range from the 3s short-term loudness (built from the 400ms blocks)"""
+    per_window = (SHORT_TERM_MS - BLOCK_MS) // HOP_MS + 1
+    if len(powers) < per_window:
+        return 0.0
+    csum = np.concatenate(([0], np.cumsum(powers)))
+    short_term = (csum[per_window:] - csum[:-per_window]) / per_window
+    levels = _loudness(short_term)
+    gated = short_term[levels > ABSOLUTE_GATE]
+    if not gated.size:
+        return 0.0
+    threshold = _loudness(gated.mean()) + LRA_RELATIVE_GATE
+    kept = levels[(levels > ABSOLUTE_GATE) & (levels > threshold)]
+    low, high = np.percentile(kept, (10, 95))
+    return float(high - low)
+
+
+def true_peak(segment, chunk_size=1 << 18, margin=256):
+    """Highest peak of the signal oversampled 4 times, in dBTP.
+
+    Oversampled by zero-padding the spectrum of overlapping chunks; the margins absorb the edge effects."""
+    frames, offset, full_scale = _frames(segment)
+    if not len(frames):
+        return -np.inf
+    chunk = chunk_size - 2 * margin
+    factor = TRUE_PEAK_OVERSAMPLING
+    peak = 0.0
+    for start in range(0, len(frames), chunk):
+        lo, hi = max(0, start - margin), min(len(frames), start + chunk + margin)
+        x = (frames[lo:hi].astype(np.float32) - offset) / full_scale
+        n = _fft_size(len(x))
+        upsampled = np.fft.irfft(np.fft.rfft(x, n, axis=0), n * factor, axis=0) * factor
+        keep = upsampled[(start - lo) * factor:(min(start + chunk, len(frames)) - lo) * factor]
+        peak = max(peak, float(np.abs(keep).max()), float(np.abs(x).max()))
+    return 20 * np.log10(peak) if peak > 0 else -np.inf
+
+
+def measure_loudness(segment):
+    """Loudness of a pydub AudioSegment, measured from the PCM already in memory"""
+    powers = block_powers(segment)
+    return Loudness(integrated_loudness(powers), true_peak(segment), loudness_range(powers))
+
+
+def normalization_gain(loudness, target, max_true_peak=-1.0):
+    """Gain in dB bringing a session to the target loudness without its true peak going over max_true_peak"""
+    if not np.isfinite(loudness.integrated):
+        return 0.0
+    return min(target - loudness.integrated, max_true_peak - loudness.true_peak)
+
+
+def replaygain_tags(loudness):
+    """ReplayGain 2.0 track tags of a session"""
+    if not np.isfinite(loudness.integrated):
+        return {}
+    return {
+        'REPLAYGAIN_TRACK_GAIN': f'{REPLAYGAIN_REFERENCE - loudness.integrated:.2f} dB',
+        'REPLAYGAIN_TRACK_PEAK': f'{10 ** (loudness.true_peak / 20):.6f}',
+    }
+
+
+def write_mp4_replaygain(path, tags):
+    """Add ReplayGain tags to an m4a as the iTunes freeform atoms players read: the mov muxer has no atom
+    for them, and its use_metadata_tags keys are not read by iTunes-style taggers"""
+    if not tags:
+        return
+    audio = MP4(path)
+    if audio.tags is None:
+        audio.add_tags()
+    for name, value in tags.items():
+        audio.tags[f'----:com.apple.iTunes:{name.lower()}'] = [MP4FreeForm(value.encode('utf-8'))]
+    audio.save()
+
+
+def manifest_path(out_path):
+    """Loudness manifest of an export, kept next to its outputs"""
+    return Path(out_path) / _MANIFEST_FILE
+
+
+def record_loudness(out_path, output, audio_file, s_name, loudness, gain_db=0.0, target=None):
+    """Append the measurement of a session to the manifest of out_path (the last line of an output wins).
+    target is the LUFS it was normalized to, None when only measured"""
+    entry = {'output': str(Path(output).relative_to(out_path)), 'audio_file': audio_file, 'session': s_name,
+             **loudness.to_json(), 'gain_db': round(gain_db, 2), 'target_lufs': target,
+             'date': datetime.now().isoformat(timespec='seconds')}
+    with _manifest_lock, open(manifest_path(out_path), 'a') as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+
+def recorded_gain(out_path, output):
+    """Gain in dB applied to an output of the manifest of out_path (0 when it was never normalized)"""
+    entry = load_loudness_manifest(out_path).get(str(Path(output).relative_to(out_path)))
+    return entry['gain_db'] if entry else 0.0
+
+
+def move_loudness_entries(out_path, moves):
+    """Carry the measurements of moved outputs ((old, new) paths) over to their new path"""
+    entries = load_loudness_manifest(out_path)
+    lines = [json.dumps({**entries[rel], 'output': str(Path(dst).relative_to(out_path))}, ensure_ascii=False)
+             for rel, dst in ((str(Path(src).relative_to(out_path)), dst) for src, dst in moves) if rel in entries]
+    if lines:
+        with _manifest_lock, open(manifest_path(out_path), 'a') as f:
+            f.write(''.join(line + '\n' for line in lines))
+
+
+def loudness_level(loudness):
+    """What the loudness option of an export does to its outputs: None, 'measured' (ReplayGain tags only)
+    or the target LUFS they are normalized to"""
+    if not loudness:
+        return None
+    return 'measured' if isinstance(loudness, bool) else float(loudness)
+
+
+def recorded_level(entry):
+    """loudness_level an output of the manifest was encoded with (entry None: never measured)"""
+    if entry is None:
+        return None
+    if 'target_lufs' in entry:
+        return loudness_level(True if entry['target_lufs'] is None else entry['target_lufs'])
+    # recorded without its target: a normalized output can't be told apart from another target
+    return 'measured' if not entry['gain_db'] else ('gain', entry['gain_db'])
+
+
+def load_loudness_manifest(out_path):
+    """{output: entry} of the manifest of out_path"""
+    path = manifest_path(out_path)
+    if not path.is_file():
+        return {}
+    entries = {}
+    for line in path.read_text().splitlines():
+        if line.strip():
+            entry = json.loads(line)
+            entries[entry['output']] = entry
+    return entries
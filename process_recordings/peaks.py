@@ -0,0 +1,91 @@
+import struct
+from pathlib import Path
+
+import numpy as np
+
+# samples per pixel of each resolution, every level a multiple of the previous one
+PEAKS_ZOOMS = (256, 2048, 16384)
+PEAKS_BITS = 8
+
+_DAT_VERSION = 2
+_FLAG_8_BITS = 0x1
+
+
+def peaks_paths(out_file, zooms=PEAKS_ZOOMS):
+    """Peak files of an output: "<stem>.<zoom>.dat" next to it"""
+    out_file = Path(out_file)
+    return [out_file.with_name(f'{out_file.stem}.{zoom}.dat') for zoom in zooms]
+
+
+def base_peaks(segment, samples_per_pixel, chunk_pixels=8192):
+    """Min/max of each samples_per_pixel frames of a pydub AudioSegment, mixed down across channels.
+
+    Works on the PCM buffer already in memory, a chunk at a time, so no float copy of the session is made."""
+    width = segment.sample_width
+    dtype = {1: np.uint8, 2: np.int16, 4: np.int32}[width]
+    frames = np.frombuffer(segment.raw_data, dtype=dtype).reshape(-1, segment.channels)
+    chunk = samples_per_pixel * chunk_pixels
+    lows, highs = [], []
+    for i in range(0, len(frames), chunk):
+        block = frames[i:i + chunk]
+        low, high = block.min(axis=1), block.max(axis=1)
+        pad = -len(low) % samples_per_pixel
+        if pad:
+            low = np.concatenate((low, np.repeat(low[-1:], pad)))
+            high = np.concatenate((high, np.repeat(high[-1:], pad)))
+        lows.append(low.reshape(-1, samples_per_pixel).min(axis=1))
+        highs.append(high.reshape(-1, samples_per_pixel).max(axis=1))
+    lows, highs = np.concatenate(lows).astype(np.float32), np.concatenate(highs).astype(np.float32)
+    # 8 bit wav is unsigned
+    offset, full_scale = (128, 128) if width == 1 else (0, float(1 << (8 * width - 1)))
+    return (lows - offset) / full_scale, (highs - offset) / full_scale
+
+
+def compute_peaks(segment, zooms=PEAKS_ZOOMS):
+    """Min/max envelope of a session at each zoom level.
+
+    Only the finest level is computed from the samples; coarser ones are reduced from it."""
+    zooms = sorted(zooms)
+    lows, highs = base_peaks(segment, zooms[0])
+    levels = {zooms[0]: (lows, highs)}
+    step = zooms[0]
+    for zoom in zooms[1:]:
+        if zoom % step:
+            raise ValueError(f'peak zoom {zoom} is not a multiple of {step}')
+        factor = zoom // step
+        pad = -len(lows) % factor
+        if pad:
+            lows = np.concatenate((lows, np.repeat(lows[-1:], pad)))
+            highs = np.concatenate((highs, np.repeat(highs[-1:], pad)))
+        lows, highs = lows.reshape(-1, factor).min(axis=1), highs.reshape(-1, factor).max(axis=1)
+        levels[zoom] = (lows, highs)
+        step = zoom
+    return levels
+
+
+def write_peaks_dat(path, lows, highs, sample_rate, samples_per_pixel, bits=PEAKS_BITS):
+    """Write an audiowaveform (version 2, single channel) .dat file"""
+    scale, dtype = (127, np.int8) if bits == 8 else (32767, np.int16)
+    data = np.empty(2 * len(lows), dtype=dtype)
+    data[0::2] = np.clip(np.round(lows * scale), -scale - 1, scale)
+    data[1::2] = np.clip(np.round(highs * scale), -scale - 1, scale)
+    header = struct.pack('<iIiiIi', _DAT_VERSION, _FLAG_8_BITS if bits == 8 else 0,
+                         sample_rate, samples_per_pixel, len(lows), 1)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(data.astype('<' + data.dtype.str[1:], copy=False).tobytes())
+
+
+def export_peaks(segment, out_file, zooms=PEAKS_ZOOMS):
+    """Write the missing peak files of an output from the session audio already in memory"""
+    missing = {zoom: path for zoom, path in zip(zooms, peaks_paths(out_file, zooms)) if not path.is_file()}
+    if not missing or not len(segment.raw_data):
+        return []
+    # the finest level is needed to reduce the coarser ones, even when only those are missing
+    levels = compute_peaks(segment, zooms)
+    for zoom, path in missing.items():
+        lows, highs = levels[zoom]
+        write_peaks_dat(path, lows, highs, segment.frame_rate, zoom)
+    return list(missing.values())
@@ -0,0 +1,134 @@
+import concurrent.futures
+import errno
+import os
+import threading
+from pathlib import Path
+from shutil import copyfileobj
+
+try:
+    import fcntl
+    _FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+except ImportError:  # not on Linux/macOS
+    fcntl = None
+
+# errors meaning "this strategy is not available here", so the next one should be tried
+_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL,
+                errno.ENOSYS, errno.EMLINK, errno.ENOTTY, errno.EACCES}
+
+
+def _tmp_path(dst):
+    return dst.with_name(f'.{dst.name}.{os.getpid()}-{threading.get_ident()}.tmp')
+
+
+def _reflink(src, tmp):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, 'reflinks need fcntl')
+    with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+
+
+def _copy_range(src, tmp):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range not available')
+    with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(remaining, 1 << 30))
+            if copied == 0:
+                # some filesystems (procfs-like, some FUSE) report 0 instead of failing: let a streamed copy do it
+                raise OSError(errno.ENOTSUP, f'copy_file_range stopped with {remaining} bytes left')
+            remaining -= copied
+
+
+def _stream_copy(src, tmp):
+    with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+        copyfileobj(fsrc, fdst, 1 << 20)
+
+
+_STRATEGIES = (('link', os.link), ('reflink', _reflink), ('copy_file_range', _copy_range), ('copy', _stream_copy))
+
+
+def publish_file(src, dst, allow_hardlink=True):
+    """Make dst have the content of src as cheaply as the filesystem allows, replacing dst atomically.
+
+    Tries a hardlink, then a reflink (FICLONE), then an in-kernel copy_file_range, and finally a
+    streamed copy. Returns the name of the strategy that worked."""
+    src, dst = Path(src), Path(dst)
+    if allow_hardlink and dst.exists() and os.path.samefile(src, dst):
+        return 'link'  # already published by an earlier run
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = _tmp_path(dst)
+    for name, strategy in _STRATEGIES:
+        if name == 'link' and not allow_hardlink:
+            continue
+        tmp.unlink(missing_ok=True)
+        try:
+            strategy(src, tmp)
+        except OSError as e:
+            tmp.unlink(missing_ok=True)
+            if e.errno in _UNSUPPORTED and name != 'copy':
+                continue
+            raise
+        os.replace(tmp, dst)
+        # a no-op when tmp and dst were already the same file, which leaves tmp behind
+        tmp.unlink(missing_ok=True)
+        return name
+
+
+def move_file(src, dst):
+    """Rename src to dst, falling back to publish + unlink across filesystems"""
+    src, dst = Path(src), Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.replace(src, dst)
+        return 'rename'
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    strategy = publish_file(src, dst, allow_hardlink=False)
+    src.unlink()
+    return strategy
+
+
+def prune_empty_dirs(dirs, root):
+    """Remove the given folders and their parents while they are empty, up to (not including) root"""
+    root = Path(root)
+    for parent in sorted({Path(d) for d in dirs}, key=lambda p: len(p.parts), reverse=True):
+        while root in parent.parents:
+            try:
+                parent.rmdir()
+            except OSError:
+                break  # not empty, or already gone
+            parent = parent.parent
+
+
+def remove_stale_outputs(paths, root):
+    """Delete files and then the folders they leave empty under root"""
+    removed = 0
+    parents = set()
+    for path in paths:
+        path = Path(path)
+        if path.is_file():
+            path.unlink()
+            removed += 1
+            parents.add(path.parent)
+    prune_empty_dirs(parents, root)
+    return removed
+
+
+def publish_files(pairs, max_workers=8, move=False):
+    """Publish or move many (src, dst) pairs with a bounded thread pool.
+
+    Returns the number of files published and the list of (src, dst, error) that failed."""
+    func = move_file if move else publish_file
+    done, failed = 0, []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_pair = {executor.submit(func, src, dst): (src, dst) for src, dst in pairs}
+        for future in concurrent.futures.as_completed(future_to_pair):
+            src, dst = future_to_pair[future]
+            try:
+                future.result()
+                done += 1
+            except OSError as e:
+                failed.append((src, dst, e))
+    return done, failed
@@ -0,0 +1,279 @@
+import hashlib
+import shutil
+import subprocess
+from collections import defaultdict
+from functools import lru_cache
+from pathlib import Path
+
+from pydub.utils import get_encoder_name
+
+from .peaks import PEAKS_BITS
+from .tags import TAG_FORMATS, write_tags
+
+
+class Rendition:
+    """A low-bitrate streaming rendition, encoded by ffmpeg straight from the session PCM"""
+    __slots__ = ('name', 'folder', 'suffix', 'codec', 'bitrate', 'options')
+
+    def __init__(self, name, folder, suffix, codec, bitrate, options=()):
+        self.name = name
+        self.folder = folder  # top folder in the final layout, next to WAV and MP3
+        self.suffix = suffix
+        self.codec = codec
+        self.bitrate = bitrate
+        self.options = tuple(options)
+
+    def params(self):
+        return {'codec': self.codec, 'bitrate': self.bitrate, 'options': self.options}
+
+    def __repr__(self):
+        return f'Rendition({self.name!r}, {self.codec}, {self.bitrate})'
+
+
+HLS_SEGMENT_SECONDS = 6
+
+STREAMING_RENDITIONS = {
+    'opus': Rendition('opus', 'OPUS', '.opus', 'libopus', '32k', ('-ar', '48000', '-application', 'voip')),
+    # fMP4 segments in a folder named after the session, with the playlist inside
+    'hls': Rendition('hls', 'HLS', '.m3u8', 'aac', '64k',
+                     ('-f', 'hls', '-hls_time', str(HLS_SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+                      '-hls_segment_type', 'fmp4', '-hls_fmp4_init_filename', 'init.mp4')),
+}
+
+# streaming renditions produced for each output layout of gen_outpaths (final_filename or not)
+LAYOUT_RENDITIONS = {
+    True: ('opus', 'hls'),  # New Archives, published to listeners
+    False: ('opus',),       # sessions cut from the cassette sides
+}
+
+# export arguments for each encoding we produce
+ENCODINGS = {
+    'wav': {'format': 'wav', 'parameters': []},
+    # iTunes atoms only: ReplayGain is added afterwards as freeform atoms (see write_mp4_replaygain)
+    'm4a': {'format': 'ipod', 'bitrate': '256k', 'parameters': ['-q:a', '2']},
+    'mp3': {'format': 'mp3'},
+    # not pydub: min/max peak files computed from the session audio
+    'peaks': {'format': 'audiowaveform', 'bits': PEAKS_BITS},
+}
+
+_FINGERPRINT_SPAN = 1 << 20
+
+
+def output_encodings(outputs):
+    """Encoding name of each session output: the first is always a wav, the second follows its suffix,
+    peak files ("<stem>.<zoom>.dat") are told apart by their zoom"""
+    out_file, out_file_compressed, *extra = outputs
+    compressed = 'm4a' if 'm4a' in out_file_compressed.suffix else 'mp3' if 'mp3' in out_file_compressed.suffix else None
+    encodings = [(out_file, 'wav'), (out_file_compressed, compressed)]
+    by_suffix = {r.suffix: name for name, r in STREAMING_RENDITIONS.items()}
+    for out in extra:
+        if out.suffix == '.dat':
+            encodings.append((out, f'peaks:{Path(out.stem).suffix[1:]}'))
+        else:
+            encodings.append((out, by_suffix.get(out.suffix)))
+    return encodings
+
+
+@lru_cache(maxsize=4096)
+def _fingerprint(path, size, mtime_ns):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(size).encode())
+    with open(path, 'rb') as f:
+        h.update(f.read(_FINGERPRINT_SPAN))
+        if size > 2 * _FINGERPRINT_SPAN:
+            f.seek(-_FINGERPRINT_SPAN, 2)
+            h.update(f.read(_FINGERPRINT_SPAN))
+    return h.hexdigest()
+
+
+def source_fingerprint(path):
+    """Cheap content fingerprint of a source recording: its size plus a hash of its first and last MB"""
+    path = Path(path)
+    st = path.stat()
+    return _fingerprint(str(path), st.st_size, st.st_mtime_ns)
+
+
+def part_ranges(s, final_filename, aligned=None):
+    """The (start, duration) slices a session is cut from, shifted by the SourceAlignment of its source if any.
+
+    'whole' stands for the whole side, None for a session with missing timecodes"""
+    ranges = []
+    for _, part in s:
+        start, duration = part['start'], part['duration']
+        if not duration and final_filename:
+            # the whole side is appended after the parts before it
+            ranges.append('whole')
+            break
+        elif not duration:
+            return None
+        if aligned is not None:
+            start, end = aligned.map(start), aligned.map(start + duration)
+            duration = end - start
+        ranges.append((start, duration))
+    return tuple(ranges)
+
+
+def encoding_params(encoding):
+    name = encoding.split(':')[0]
+    if name in STREAMING_RENDITIONS:
+        return STREAMING_RENDITIONS[name].params()
+    return ENCODINGS[name]
+
+
+def rendition_key(fingerprint, ranges, encoding):
+    return fingerprint, ranges, encoding, repr(sorted(encoding_params(encoding).items()))
+
+
+class RenditionPlan:
+    """Which outputs to encode, and which to link from an identical rendition"""
+    __slots__ = ('encode', 'prelinks', 'links')
+
+    def __init__(self):
+        self.encode = []    # tasks that produce at least one unique rendition
+        self.prelinks = []  # (existing file, output) pairs that can be linked right away
+        self.links = []     # (output, output) pairs to link once the first one is encoded
+
+
+def plan_renditions(all_tasks, pending_tasks, sources, outputs_of, variant_of=None, alignment=None):
+    """Group the outputs of a batch by rendition key so that each unique rendition is encoded once.
+
+    all_tasks are every session of the batch (already exported ones can serve as link sources),
+    pending_tasks the ones missing outputs, sources maps audio files to their source path and
+    outputs_of gives the output paths of a task. variant_of(task, out, encoding) gives what else ends up in
+    an output (tags, level...): only outputs of the same variant are shared.
+    alignment maps audio files to the SourceAlignment their sessions are cut with."""
+    plan = RenditionPlan()
+    fingerprints = {}
+    by_key = defaultdict(list)
+    pending = {id(t) for t in pending_tasks}
+    for task in all_tasks:
+        audio_file, _, s, _, final_filename = task
+        if audio_file not in sources:
+            continue
+        if audio_file not in fingerprints:
+            try:
+                fingerprints[audio_file] = source_fingerprint(sources[audio_file])
+            except OSError:
+                fingerprints[audio_file] = None
+        ranges = part_ranges(s, final_filename, alignment.get(audio_file) if alignment else None)
+        for out, encoding in output_encodings(outputs_of(task)):
+            if fingerprints[audio_file] is None or ranges is None or encoding is None:
+                key = ('unique', out)
+            else:
+                key = rendition_key(fingerprints[audio_file], ranges, encoding)
+                if variant_of is not None:
+                    key += (variant_of(task, out, encoding),)
+            by_key[key].append((task, out))
+
+    to_encode = {}
+    for key, renditions in by_key.items():
+        existing = next((out for _, out in renditions if out.is_file()), None)
+        missing = [(task, out) for task, out in renditions if id(task) in pending and not out.is_file()]
+        if not missing:
+            continue
+        if existing is not None:
+            plan.prelinks.extend((existing, out) for _, out in missing)
+            continue
+        (first_task, first_out), rest = missing[0], missing[1:]
+        to_encode[id(first_task)] = first_task
+        plan.links.extend((first_out, out) for _, out in rest)
+
+    # keep the batch order
+    plan.encode = [t for t in pending_tasks if id(t) in to_encode]
+    return plan
+
+
+def link_pairs(pairs):
+    """Expand (src, dst) pairs of HLS playlists to every file of their folder, the playlist last"""
+    expanded = []
+    for src, dst in pairs:
+        if src.suffix != STREAMING_RENDITIONS['hls'].suffix:
+            expanded.append((src, dst))
+            continue
+        expanded.extend((f, dst.parent / f.name) for f in sorted(src.parent.iterdir()) if f != src)
+        expanded.append((src, dst))
+    return expanded
+
+
+def rendition_files(outputs):
+    """Files making up the given outputs: an HLS playlist stands for its whole folder of segments"""
+    files = []
+    for out in outputs:
+        if out.suffix == STREAMING_RENDITIONS['hls'].suffix and out.is_file():
+            files.extend(f for f in sorted(out.parent.iterdir()) if f != out)
+        files.append(out)
+    return files
+
+
+def streaming_names(streaming, final_filename):
+    """Rendition names asked for by an export: True for the layout's defaults, or explicit names"""
+    if not streaming:
+        return ()
+    if streaming is True:
+        return LAYOUT_RENDITIONS[final_filename]
+    return tuple(streaming)
+
+
+def streaming_paths(out_file_compressed, out_path, final_filename, streaming=True):
+    """(rendition, path) of the streaming renditions of a session, laid out like its compressed output"""
+    paths = []
+    for name in streaming_names(streaming, final_filename):
+        rendition = STREAMING_RENDITIONS[name]
+        if final_filename:
+            # New Archives: <out>/<RENDITION>/... mirrors <out>/MP3/...
+            out = out_path / rendition.folder / out_file_compressed.relative_to(out_path / 'MP3')
+        else:
+            out = out_file_compressed
+        if name == 'hls':
+            out = out.parent / out.stem / (out.stem + rendition.suffix)
+        else:
+            out = out.with_suffix(rendition.suffix)
+        paths.append((rendition, out))
+    return paths
+
+
+def _pcm_format(segment):
+    return {1: 'u8', 2: 's16le', 4: 's32le'}[segment.sample_width]
+
+
+def encode_rendition(segment, rendition, out, tags=None, extra_tags=None):
+    """Encode a pydub AudioSegment to a streaming rendition, feeding its PCM to ffmpeg on stdin.
+
+    tags are the ones we manage, written with write_tags where the container is supported, extra_tags
+    (ReplayGain) are left to ffmpeg. The output (or the HLS folder) is written under a temporary name and
+    renamed once complete."""
+    out = Path(out)
+    tagged = rendition.suffix in TAG_FORMATS
+    metadata = []
+    for k, v in {**({} if tagged else tags or {}), **(extra_tags or {})}.items():
+        metadata += ['-metadata', f'{k}={v}']
+    cmd = [get_encoder_name(), '-v', 'error', '-nostdin', '-y',
+           '-f', _pcm_format(segment), '-ar', str(segment.frame_rate), '-ac', str(segment.channels), '-i', '-',
+           *metadata, '-c:a', rendition.codec, '-b:a', rendition.bitrate, *rendition.options]
+    if rendition.name == 'hls':
+        final_dir = out.parent
+        tmp_dir = final_dir.with_name(f'.{final_dir.name}.tmp')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+        cmd += ['-hls_segment_filename', str(tmp_dir / 'segment_%05d.m4s'), str(tmp_dir / out.name)]
+    else:
+        out.parent.mkdir(parents=True, exist_ok=True)
+        tmp = out.with_name(f'.{out.stem}.tmp{out.suffix}')
+        cmd += ['-f', rendition.suffix[1:], str(tmp)]
+
+    proc = subprocess.run(cmd, input=segment.raw_data, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if proc.returncode:
+        if rendition.name == 'hls':
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        else:
+            tmp.unlink(missing_ok=True)
+        raise RuntimeError(f'ffmpeg failed encoding {out.name}: {proc.stderr.decode(errors="replace").strip()}')
+
+    if rendition.name == 'hls':
+        shutil.rmtree(final_dir, ignore_errors=True)
+        tmp_dir.replace(final_dir)
+    else:
+        if tagged:
+            write_tags(tmp, tags or {})
+        tmp.replace(out)
+    return out
@@ -0,0 +1,61 @@
+import concurrent.futures
+import os
+from pathlib import Path
+
+from .chunk_recordings import (parse_catalog, keep_sessions_with_export_name, session_outputs, session_tags,
+                               managed_tags, errors)
+from .publish import publish_file
+from .tags import TAG_FORMATS, read_tags, write_tags
+
+
+def retag_file(path, tags):
+    """Rewrite the tags we manage in one output, leaving the audio and the other tags (ReplayGain...) alone.
+
+    Returns False when the file already has them. A file hardlinked to the output of another session (see
+    plan_renditions) is first given its own copy, a reflink where the filesystem allows."""
+    wanted = {name: tags[name] for name in managed_tags() if tags.get(name)}
+    if read_tags(path) == wanted:
+        return False
+    if os.stat(path).st_nlink > 1:
+        publish_file(path, path, allow_hardlink=False)
+    write_tags(path, wanted)
+    return True
+
+
+def retag_sessions(sessions, out_path, final_filename, max_workers=16):
+    """Retag the existing outputs of (audio_file, session name, parts) sessions with their catalog tags.
+
+    Returns the number of files rewritten."""
+    out_path = Path(out_path)
+    # a session and its translation share their outputs in the final layout: each file is rewritten once
+    jobs = {}
+    for audio_file, s_name, s in sessions:
+        tags = session_tags(s)
+        for out in session_outputs(audio_file, s_name, s, out_path, final_filename, streaming=True):
+            if out.suffix in TAG_FORMATS and out not in jobs and out.is_file():
+                jobs[out] = tags
+    print(f"Checking the tags of {len(jobs)} outputs using {max_workers} workers...")
+
+    retagged = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_path = {executor.submit(retag_file, out, tags): out for out, tags in jobs.items()}
+        for future in concurrent.futures.as_completed(future_to_path):
+            out = future_to_path[future]
+            try:
+                if future.result():
+                    retagged += 1
+            except Exception as e:
+                errors.append(f"Error retagging {out}: {e}")
+                print(f"  ✗ {out}: {e}")
+    print(f"  - Files retagged: {retagged} ({len(jobs) - retagged} already up to date)")
+    return retagged
+
+
+def retag_outputs(catalog, out_path, final_filename=True, single_file='', max_workers=16):
+    """Bring the tags of every output in line with the catalog and the project tags, without re-encoding"""
+    _, catalog_sessions = parse_catalog(catalog, renamed_export=final_filename)
+    if final_filename:
+        catalog_sessions = keep_sessions_with_export_name(catalog_sessions)
+    sessions = [(audio_file, s_name, s) for audio_file, file_sessions in catalog_sessions.items()
+                if not single_file or audio_file == single_file for s_name, s in file_sessions.items()]
+    return retag_sessions(sessions, out_path, final_filename, max_workers=max_workers)
@@ -0,0 +1,149 @@
+import json
+import multiprocessing
+import os
+import signal
+import time
+from collections import deque
+from datetime import datetime
+from multiprocessing.connection import wait
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+# wall-clock budget of one job and the address space a worker (and the ffmpeg it spawns) may use
+DEFAULT_TIMEOUT = 2 * 3600
+DEFAULT_MEMORY_LIMIT = 8 * 1024 ** 3
+
+
+def _context():
+    # fork shares the parsed catalog with the workers instead of pickling it for each of them
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+
+
+def _child(func, args, conn, memory_limit):
+    # own process group, so that a kill also takes down the ffmpeg processes started by the job
+    if hasattr(os, 'setsid'):
+        os.setsid()
+    if memory_limit and resource is not None:
+        # RLIMIT_RSS is not enforced by Linux: capping the address space is what actually bounds memory
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    try:
+        conn.send(('ok', func(*args)))
+    except BaseException as e:
+        conn.send(('error', f'{type(e).__name__}: {e}' if str(e) else type(e).__name__))
+    finally:
+        conn.close()
+
+
+class _Job:
+    __slots__ = ('job_id', 'args', 'attempts', 'process', 'conn', 'started', 'outcome')
+
+    def __init__(self, job_id, args):
+        self.job_id = job_id
+        self.args = args
+        self.attempts = 0
+        self.process = self.conn = self.started = self.outcome = None
+
+    def start(self, ctx, func, memory_limit):
+        self.attempts += 1
+        self.outcome = None
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        self.conn = parent_conn
+        self.process = ctx.Process(target=_child, args=(func, self.args, child_conn, memory_limit), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.started = time.monotonic()
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (AttributeError, ProcessLookupError, PermissionError):
+            self.process.kill()
+        self.process.join()
+
+
+def load_quarantine(quarantine):
+    """Ids of the jobs quarantined by earlier runs"""
+    quarantine = Path(quarantine)
+    if not quarantine.is_file():
+        return set()
+    ids = set()
+    for line in quarantine.read_text().splitlines():
+        if line.strip():
+            ids.add(json.loads(line)['job'])
+    return ids
+
+
+def _quarantine(quarantine, job_id, reason, attempts):
+    quarantine = Path(quarantine)
+    quarantine.parent.mkdir(parents=True, exist_ok=True)
+    with open(quarantine, 'a') as f:
+        f.write(json.dumps({'job': job_id, 'reason': reason, 'attempts': attempts,
+                            'date': datetime.now().isoformat(timespec='seconds')}, ensure_ascii=False) + '\n')
+
+
+def run_supervised(func, jobs, processes=2, timeout=DEFAULT_TIMEOUT, memory_limit=DEFAULT_MEMORY_LIMIT,
+                   retries=1, quarantine=None, on_result=None):
+    """Run func(*args) for each (job_id, args) of jobs, each in its own worker process.
+
+    A job that raises, dies (segfault, memory limit) or runs past timeout seconds is killed with its
+    process group and retried up to retries times, then written to the quarantine file, whose jobs
+    are skipped on later runs. Returns ({job_id: result}, {job_id: reason})."""
+    ctx = _context()
+    skipped = load_quarantine(quarantine) if quarantine else set()
+    pending = deque(_Job(job_id, args) for job_id, args in jobs if job_id not in skipped)
+    if skipped:
+        print(f"Skipping {len(skipped)} quarantined jobs (see {quarantine})")
+    running = []
+    results, failures = {}, {}
+
+    while pending or running:
+        while pending and len(running) < processes:
+            job = pending.popleft()
+            job.start(ctx, func, memory_limit)
+            running.append(job)
+
+        ready = wait([j.conn for j in running] + [j.process.sentinel for j in running], timeout=1.0)
+        now = time.monotonic()
+        for job in list(running):
+            if job.conn in ready and job.outcome is None:
+                try:
+                    job.outcome = job.conn.recv()
+                except EOFError:
+                    pass
+            if job.outcome is None and job.process.sentinel not in ready:
+                if timeout and now - job.started > timeout:
+                    job.kill()
+                    job.outcome = ('error', f'timed out after {timeout}s')
+                else:
+                    continue
+            elif job.outcome is None:
+                job.process.join()
+                code = job.process.exitcode
+                reason = f'killed by signal {-code}' if code and code < 0 else f'exited with code {code}'
+                job.outcome = ('error', f'worker died ({reason})')
+            else:
+                job.process.join(timeout=5)
+                if job.process.is_alive():
+                    job.kill()
+
+            running.remove(job)
+            job.conn.close()
+            status, payload = job.outcome
+            if status == 'ok':
+                results[job.job_id] = payload
+                if on_result:
+                    on_result(job.job_id, payload)
+            elif job.attempts <= retries:
+                print(f"  ↻ {job.job_id}: {payload} (retrying)")
+                pending.append(job)
+            else:
+                print(f"  ✗ {job.job_id}: {payload} (quarantined)")
+                failures[job.job_id] = payload
+                if quarantine:
+                    _quarantine(quarantine, job.job_id, payload, job.attempts)
+    return results, failures
@@ -0,0 +1,196 @@
+import struct
+from pathlib import Path
+
+from mutagen.id3 import ID3, ID3NoHeaderError, TIT2, TPE1, TALB, TCOP, COMM, TXXX
+from mutagen.mp4 import MP4
+from mutagen.oggopus import OggOpus
+
+# where each tag we manage lives in every container we write
+_ID3_TEXT = {'title': TIT2, 'artist': TPE1, 'album': TALB, 'copyright': TCOP}
+_MP4_ATOMS = {'title': '©nam', 'artist': '©ART', 'album': '©alb', 'comment': '©cmt', 'copyright': 'cprt',
+              'description': 'desc'}
+_INFO_IDS = {'title': b'INAM', 'artist': b'IART', 'album': b'IPRD', 'comment': b'ICMT', 'copyright': b'ICOP',
+             'description': b'ISBJ'}
+TAG_NAMES = tuple(_INFO_IDS)
+
+
+# ---- ID3 (mp3) ------------------------------------------------------------------------------------------------
+
+def _read_id3(path):
+    try:
+        tag = ID3(path)
+    except ID3NoHeaderError:
+        return {}
+    tags = {name: str(tag[frame.__name__]) for name, frame in _ID3_TEXT.items() if frame.__name__ in tag}
+    comments = [c for c in tag.getall('COMM') if c.desc == '']
+    if comments:
+        tags['comment'] = str(comments[0])
+    elif 'TXXX:comment' in tag:
+        # where ffmpeg puts it
+        tags['comment'] = str(tag['TXXX:comment'])
+    if 'TXXX:description' in tag:
+        tags['description'] = str(tag['TXXX:description'])
+    return tags
+
+
+def _write_id3(path, tags):
+    try:
+        tag = ID3(path)
+    except ID3NoHeaderError:
+        tag = ID3()
+    for name, frame in _ID3_TEXT.items():
+        tag.delall(frame.__name__)
+        if name in tags:
+            tag.add(frame(encoding=3, text=tags[name]))
+    tag.setall('COMM', [c for c in tag.getall('COMM') if c.desc != ''])
+    tag.delall('TXXX:comment')
+    if 'comment' in tags:
+        tag.add(COMM(encoding=3, lang='eng', desc='', text=tags['comment']))
+    tag.delall('TXXX:description')
+    if 'description' in tags:
+        tag.add(TXXX(encoding=3, desc='description', text=tags['description']))
+    tag.save(path)
+
+
+# ---- MP4 (m4a) and Vorbis comments (opus) ---------------------------------------------------------------------
+
+def _read_mp4(path):
+    tag = MP4(path).tags or {}
+    return {name: str(tag[atom][0]) for name, atom in _MP4_ATOMS.items() if atom in tag}
+
+
+def _write_mp4(path, tags):
+    audio = MP4(path)
+    if audio.tags is None:
+        audio.add_tags()
+    for name, atom in _MP4_ATOMS.items():
+        if name in tags:
+            audio.tags[atom] = [tags[name]]
+        else:
+            audio.tags.pop(atom, None)
+    audio.save()
+
+
+def _read_opus(path):
+    tag = OggOpus(path).tags
+    return {name: tag[name][0] for name in TAG_NAMES if name in tag}
+
+
+def _write_opus(path, tags):
+    audio = OggOpus(path)
+    for name in TAG_NAMES:
+        if name in tags:
+            audio.tags[name] = [tags[name]]
+        elif name in audio.tags:
+            del audio.tags[name]
+    audio.save()
+
+
+# ---- RIFF INFO (wav) ------------------------------------------------------------------------------------------
+
+def _riff_chunks(f, file_size):
+    """(offset, id, size) of the top level chunks of a RIFF file"""
+    chunks = []
+    offset = 12
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        chunk_id, size = struct.unpack('<4sI', f.read(8))
+        chunks.append((offset, chunk_id, size))
+        offset += 8 + size + (size & 1)
+    if offset > file_size + 1:
+        raise ValueError(f'{chunk_id!r} chunk runs past the end of the file')
+    return chunks
+
+
+def _info_chunks(f, chunks):
+    info = []
+    for offset, chunk_id, size in chunks:
+        if chunk_id == b'LIST' and size >= 4:
+            f.seek(offset + 8)
+            if f.read(4) == b'INFO':
+                info.append((offset, size))
+    return info
+
+
+def _info_items(f, offset, size):
+    """[(id, bytes)] of a LIST INFO chunk"""
+    items = []
+    f.seek(offset + 12)
+    data = f.read(size - 4)
+    pos = 0
+    while pos + 8 <= len(data):
+        item_id, item_size = struct.unpack('<4sI', data[pos:pos + 8])
+        items.append((item_id, data[pos + 8:pos + 8 + item_size]))
+        pos += 8 + item_size + (item_size & 1)
+    return items
+
+
+def _open_riff(f):
+    header = f.read(12)
+    if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        raise ValueError('not a RIFF WAVE file')
+    return f.seek(0, 2)
+
+
+def _read_riff_info(path):
+    with open(path, 'rb') as f:
+        file_size = _open_riff(f)
+        info = _info_chunks(f, _riff_chunks(f, file_size))
+        if not info:
+            return {}
+        items = dict(_info_items(f, *info[-1]))
+    names = {item_id: name for name, item_id in _INFO_IDS.items()}
+    return {names[i]: v.rstrip(b'\0').decode('utf-8', errors='replace') for i, v in items.items() if i in names}
+
+
+def _write_riff_info(path, tags):
+    """Rewrite the LIST INFO chunk: in place when it ends the file (as after a first retag), otherwise the old
+    one is turned into a JUNK chunk and the new one appended, so the audio data is never moved"""
+    with open(path, 'r+b') as f:
+        file_size = _open_riff(f)
+        chunks = _riff_chunks(f, file_size)
+        info = _info_chunks(f, chunks)
+        # keep what we don't manage (encoder...)
+        kept = [(i, v) for i, v in _info_items(f, *info[-1]) if i not in _INFO_IDS.values()] if info else []
+        items = kept + [(_INFO_IDS[name], tags[name].encode('utf-8') + b'\0') for name in _INFO_IDS if name in tags]
+        body = b'INFO' + b''.join(struct.pack('<4sI', i, len(v)) + v + b'\0' * (len(v) & 1) for i, v in items)
+        chunk = struct.pack('<4sI', b'LIST', len(body)) + body
+
+        end = file_size + (file_size & 1)
+        last_offset = chunks[-1][0] if chunks else None
+        for offset, _ in info:
+            if offset == last_offset:
+                end = offset
+            else:
+                f.seek(offset)
+                f.write(b'JUNK')
+        if end > file_size:  # the last chunk has an odd size and no pad byte
+            f.seek(file_size)
+            f.write(b'\0')
+        f.seek(end)
+        f.write(chunk)
+        f.truncate()
+        f.seek(4)
+        f.write(struct.pack('<I', end + len(chunk) - 8))
+
+
+TAG_FORMATS = {
+    '.mp3': (_read_id3, _write_id3),
+    '.m4a': (_read_mp4, _write_mp4),
+    '.opus': (_read_opus, _write_opus),
+    '.wav': (_read_riff_info, _write_riff_info),
+}
+
+
+def read_tags(path):
+    """The tags we manage found in an output"""
+    read, _ = TAG_FORMATS[Path(path).suffix]
+    return read(path)
+
+
+def write_tags(path, tags):
+    """Write the tags we manage to an output (the ones missing from tags are removed), leaving the others
+    (ReplayGain, encoder...) alone. Done with mutagen rather than ffmpeg, whose mapping of comment and
+    description differs from one container to the next and collides in Vorbis comments"""
+    _, write = TAG_FORMATS[Path(path).suffix]
+    write(path, tags)
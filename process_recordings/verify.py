@@ -0,0 +1,242 @@
+import concurrent.futures
+import json
+import struct
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+from mutagen import File as MutagenFile
+from mutagen import MutagenError
+from pydub.utils import get_encoder_name
+
+from .catalog_diff import parse_sessions
+from .chunk_recordings import session_outputs, export_sessions, export_final_sessions
+from .publish import remove_stale_outputs
+from .renditions import rendition_files
+
+# container each suffix must hold, recognised from the first bytes of the file
+_MAGIC = {
+    '.wav': lambda head: head[:4] == b'RIFF' and head[8:12] == b'WAVE',
+    '.mp3': lambda head: head[:3] == b'ID3' or (head[0] == 0xFF and head[1] & 0xE0 == 0xE0),
+    '.m4a': lambda head: head[4:8] == b'ftyp',
+    '.opus': lambda head: head[:4] == b'OggS',
+    '.m3u8': lambda head: head[:7] == b'#EXTM3U',
+    '.dat': lambda head: head[:4] == b'\x02\x00\x00\x00',
+}
+_TIMED = {'.wav', '.mp3', '.m4a', '.opus'}
+
+# what counts as a duration mismatch: encoders pad a little, a truncated file is off by a lot more
+TOLERANCE_MS = 500
+TOLERANCE_RATIO = 0.005
+
+
+def _wav_data_chunk(path):
+    """(offset, declared size) of the data chunk of a RIFF WAVE file"""
+    with open(path, 'rb') as f:
+        size = f.seek(0, 2)
+        offset = 12
+        while offset + 8 <= size:
+            f.seek(offset)
+            chunk_id, chunk_size = struct.unpack('<4sI', f.read(8))
+            if chunk_id == b'data':
+                return offset, chunk_size
+            offset += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+
+def _id3_size(path):
+    with open(path, 'rb') as f:
+        head = f.read(10)
+    if len(head) < 10 or head[:3] != b'ID3':
+        return 0
+    # syncsafe integer, plus the header and the optional footer
+    return 10 + (head[6] << 21 | head[7] << 14 | head[8] << 7 | head[9]) + (10 if head[5] & 0x10 else 0)
+
+
+def _stored_ms(path, info):
+    """Duration the bytes actually in a wav or mp3 can hold: their headers (the RIFF data size, the Xing
+    frame count) still state the full length once the file is cut short"""
+    size = Path(path).stat().st_size
+    if path.suffix == '.wav':
+        chunk = _wav_data_chunk(path)
+        byte_rate = info.sample_rate * info.channels * info.bits_per_sample // 8
+        if chunk is None or not byte_rate:
+            return None
+        offset, declared = chunk
+        return min(declared, size - offset - 8) * 1000 // byte_rate
+    if path.suffix == '.mp3' and info.bitrate:
+        return (size - _id3_size(path)) * 8000 // info.bitrate
+    return None
+
+
+def probe(path):
+    """(duration in ms stated by the headers, duration the file can actually hold) without decoding"""
+    path = Path(path)
+    audio = MutagenFile(str(path))
+    if audio is None or not getattr(audio, 'info', None):
+        return None, None
+    header_ms = int(audio.info.length * 1000)
+    stored_ms = _stored_ms(path, audio.info)
+    return header_ms, header_ms if stored_ms is None else min(header_ms, stored_ms)
+
+
+def probe_duration(path):
+    """Duration in ms read from the headers, short of what a truncated file is missing"""
+    return probe(path)[1]
+
+
+def decode_windows(path, duration_ms, windows=3, window_ms=2000):
+    """Decode a few windows spread over the file; returns ffmpeg's complaints, if any"""
+    problems = []
+    positions = [0] if windows == 1 else [i * max(0, duration_ms - window_ms) // (windows - 1) for i in range(windows)]
+    for pos in positions:
+        cmd = [get_encoder_name(), '-v', 'error', '-nostdin', '-ss', f'{pos / 1000:.3f}', '-t', f'{window_ms / 1000:.3f}',
+               '-i', str(path), '-f', 'null', '-']
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        stderr = proc.stderr.decode(errors='replace').strip()
+        if proc.returncode or stderr:
+            problems.append(f'decode error at {pos / 1000:.1f}s: {stderr.splitlines()[-1] if stderr else proc.returncode}')
+    return problems
+
+
+def expected_duration(s, final_filename, source=None):
+    """Duration a session should have: its parts summed, or the whole source for untimed final sessions"""
+    total = 0
+    for _, part in s:
+        if not part['duration']:
+            if final_filename and source is not None and source.is_file():
+                return probe_duration(source)
+            return None
+        total += part['duration']
+    return total
+
+
+def check_output(path, expected_ms, decode=False, tolerance_ms=TOLERANCE_MS, tolerance_ratio=TOLERANCE_RATIO):
+    """Problems found with one output (empty list when it is fine) and its probed duration"""
+    path = Path(path)
+    if not path.is_file():
+        return ['missing'], None
+    if path.stat().st_size == 0:
+        return ['empty file'], None
+    with open(path, 'rb') as f:
+        head = f.read(16)
+    check_magic = _MAGIC.get(path.suffix)
+    if check_magic is not None and (len(head) < 12 or not check_magic(head)):
+        return [f'content is not {path.suffix[1:]}'], None
+    if path.suffix not in _TIMED:
+        return [], None
+
+    try:
+        header_ms, actual_ms = probe(path)
+    except (MutagenError, OSError) as e:
+        return [f'unreadable header: {e}'], None
+    if actual_ms is None:
+        return ['unreadable header'], None
+    problems = []
+    if header_ms - actual_ms > max(tolerance_ms, header_ms * tolerance_ratio):
+        problems.append(f'truncated: {actual_ms / 1000:.1f}s of the {header_ms / 1000:.1f}s its header states')
+    if expected_ms is not None and abs(actual_ms - expected_ms) > max(tolerance_ms, expected_ms * tolerance_ratio):
+        problems.append(f'duration {actual_ms / 1000:.1f}s instead of {expected_ms / 1000:.1f}s')
+    if decode:
+        problems.extend(decode_windows(path, actual_ms))
+    return problems, actual_ms
+
+
+def verify_outputs(catalog, audio_path, out_path, final_filename=True, peaks=False, streaming=False,
+                   decode=False, report=None, max_workers=8):
+    """Check every output the catalog says should exist against its sessions, write a JSON report of the failures"""
+    audio_path, out_path = Path(audio_path), Path(out_path)
+    catalog_sessions = parse_sessions(catalog, final_filename)
+
+    checks = []
+    for audio_file, sessions in catalog_sessions.items():
+        for s_name, s in sessions.items():
+            source = audio_path / s[0][1]['Folder'] / s[0][1]['filename']
+            outputs = session_outputs(audio_file, s_name, s, out_path, final_filename, peaks=peaks, streaming=streaming)
+            checks.append((audio_file, s_name, s, source, outputs))
+    total = sum(len(c[4]) for c in checks)
+    print(f"Verifying {total} outputs of {len(checks)} sessions using {max_workers} workers...")
+
+    def check_session(audio_file, s_name, s, source, outputs):
+        expected_ms = expected_duration(s, final_filename, source)
+        results = []
+        for out in outputs:
+            problems, actual_ms = check_output(out, expected_ms, decode=decode)
+            if problems:
+                results.append({
+                    'audio_file': audio_file,
+                    'session': s_name,
+                    'path': str(out),
+                    'problems': problems,
+                    'expected_ms': expected_ms,
+                    'actual_ms': actual_ms,
+                })
+        return results
+
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(check_session, *c) for c in checks]
+        for future in concurrent.futures.as_completed(futures):
+            for failure in future.result():
+                failures.append(failure)
+                print(f"  ✗ {failure['path']}: {', '.join(failure['problems'])}")
+
+    failures.sort(key=lambda f: f['path'])
+    result = {
+        'catalog': str(catalog),
+        'out_path': str(out_path),
+        'final_filename': final_filename,
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'outputs_checked': total,
+        'failures': failures,
+    }
+    if report:
+        report = Path(report)
+        report.parent.mkdir(parents=True, exist_ok=True)
+        report.write_text(json.dumps(result, ensure_ascii=False, indent=1))
+    print(f"\nVerification complete: {len(failures)} of {total} outputs failed")
+    return result
+
+
+def load_report(report):
+    return json.loads(Path(report).read_text())
+
+
+def purge_failed_outputs(report):
+    """Delete the outputs a report flagged so that the next export run (which skips existing files) redoes them.
+
+    Returns {audio_file: {session names}} of the sessions to re-export."""
+    if not isinstance(report, dict):
+        report = load_report(report)
+    to_redo = {}
+    bad = []
+    for failure in report['failures']:
+        if failure['problems'] != ['missing']:
+            bad.append(Path(failure['path']))
+        to_redo.setdefault(failure['audio_file'], set()).add(failure['session'])
+    removed = remove_stale_outputs(rendition_files(bad), report['out_path'])
+    print(f"Removed {removed} faulty outputs of {sum(len(s) for s in to_redo.values())} sessions")
+    return to_redo
+
+
+def reexport_failed(report, catalog, audio_path, pass_missing=True, batch_size=10, max_workers=4,
+                    peaks=False, streaming=False, loudness=None):
+    """Purge what a verification report flagged and export those sessions again"""
+    if not isinstance(report, dict):
+        report = load_report(report)
+    final_filename = report['final_filename']
+    to_redo = purge_failed_outputs(report)
+    if not to_redo:
+        return
+    catalog_sessions = parse_sessions(catalog, final_filename)
+    subset = {audio_file: {s_name: s for s_name, s in catalog_sessions[audio_file].items() if s_name in names}
+              for audio_file, names in to_redo.items() if audio_file in catalog_sessions}
+    export = export_final_sessions if final_filename else export_sessions
+    export(subset, Path(audio_path), Path(report['out_path']),
+           pass_missing=pass_missing,
+           final_filename=final_filename,
+           batch_size=batch_size,
+           max_workers=max_workers,
+           peaks=peaks,
+           streaming=streaming,
+           loudness=loudness)
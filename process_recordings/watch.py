@@ -0,0 +1,253 @@
+import itertools
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from pathlib import Path
+from urllib.request import urlretrieve
+
+from .catalog_diff import (diff_sessions, parse_sessions, apply_file_changes, changes_to_export, session_key,
+                           stale_outputs, index_sessions, RETIMED)
+from .chunk_recordings import (load_audio_file, export_single_session, check_session_needs_export, session_outputs,
+                               errors)
+from .publish import remove_stale_outputs
+from .renditions import rendition_files
+
+# lanes of the queue: hand edits first, then edits touching many sides, then the initial backlog
+INTERACTIVE, BULK, BACKLOG = 0, 1, 2
+# sessions published as final come before the ones still in progress
+_STATUS_RANK = {'Synchronized': 0, '': 1, 'No Text': 1, 'Others': 1}
+_IN_PROGRESS_RANK = 2
+# a hand edit rarely touches more sides than this
+_INTERACTIVE_MAX_FILES = 1
+
+
+def status_rank(s):
+    return _STATUS_RANK.get(s[0][1]['session export status'], _IN_PROGRESS_RANK)
+
+
+class AudioCache:
+    """The few most recently used sources, decoded once even when several workers ask for them"""
+
+    def __init__(self, audio_path, pass_missing=True, size=3):
+        self.audio_path = Path(audio_path)
+        self.pass_missing = pass_missing
+        self.size = size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.loading = defaultdict(threading.Lock)
+
+    def get(self, audio_file, s):
+        with self.lock:
+            if audio_file in self.cache:
+                self.cache.move_to_end(audio_file)
+                return self.cache[audio_file]
+            file_lock = self.loading[audio_file]
+        with file_lock:
+            with self.lock:
+                if audio_file in self.cache:
+                    return self.cache[audio_file]
+            audio, error = load_audio_file(self.audio_path, s[0][1]['Folder'], s[0][1]['filename'], self.pass_missing)
+            if audio is None:
+                errors.append(f"  ✗ {error}")
+                print(f"  ✗ {error}")
+                return None
+            with self.lock:
+                self.cache[audio_file] = audio
+                while len(self.cache) > self.size:
+                    self.cache.popitem(last=False)
+            return audio
+
+
+class CatalogWatcher:
+    """Long-running exporter: re-parses the catalog when it changes and exports affected sessions by priority"""
+
+    def __init__(self, catalog, audio_path, out_path, final_filename=True, pass_missing=True, catalog_url=None,
+                 interval=2.0, max_workers=4, peaks=False, streaming=False, backlog=True, loudness=None):
+        self.catalog = Path(catalog)
+        self.out_path = Path(out_path)
+        self.final_filename = final_filename
+        self.catalog_url = catalog_url
+        self.interval = interval
+        self.max_workers = max_workers
+        self.peaks = peaks
+        self.streaming = streaming
+        self.loudness = loudness
+        self.backlog = backlog
+        self.audio = AudioCache(audio_path, pass_missing=pass_missing)
+
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        # latest version of each queued session: an older queue entry for it is dropped when popped
+        self.latest = {}
+        self.latest_lock = threading.Lock()
+        # one export of a session at a time, so that a re-export never races the one it replaces
+        self.exporting = defaultdict(threading.Lock)
+        self.stop = threading.Event()
+        self.sessions = {}
+        self.stamp = None
+
+    # ---- catalog side -------------------------------------------------------------------------------------
+
+    def _fetch(self):
+        if not self.catalog_url:
+            return
+        tmp = self.catalog.with_name(self.catalog.name + '.download')
+        try:
+            urlretrieve(self.catalog_url, tmp)
+        except OSError as e:
+            print(f"Could not download the catalog: {e}")
+            return
+        if not self.catalog.is_file() or tmp.read_bytes() != self.catalog.read_bytes():
+            tmp.replace(self.catalog)
+        else:
+            tmp.unlink()
+
+    def _changed(self):
+        try:
+            st = os.stat(self.catalog)
+        except FileNotFoundError:
+            return False
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        return True
+
+    def enqueue(self, lane, audio_file, s_name, s, stale=(), only_new=False):
+        """Queue the export of a session, after deleting the stale files (cut from its old timecodes).
+
+        With only_new, a session already queued is left alone. Returns whether it was queued"""
+        key = session_key(audio_file, s_name, s)
+        generation = next(self.counter)
+        with self.latest_lock:
+            if only_new and key in self.latest:
+                return False
+            self.latest[key] = generation
+        self.queue.put(((lane, status_rank(s), generation), key, (audio_file, s_name, s, stale)))
+        return True
+
+    def _forget(self, changes):
+        """Drop the queued exports of sessions that were removed or moved away"""
+        with self.latest_lock:
+            for change in changes:
+                self.latest.pop(change.key, None)
+
+    def reload(self):
+        """Diff the catalog against the last version seen and queue what changed"""
+        sessions = parse_sessions(self.catalog, self.final_filename)
+        diff = diff_sessions(self.sessions, sessions)
+        first = not self.sessions
+        self.sessions = sessions
+        if not diff:
+            return
+        if first:
+            # everything is "added" on startup: that is the backlog, not an edit
+            if self.backlog:
+                threading.Thread(target=self._queue_backlog, args=(diff,), daemon=True).start()
+            return
+
+        print(f"\nCatalog changed: {diff.summary()}")
+        self._forget(diff.removed + diff.moved)
+        moved = apply_file_changes(diff, self.out_path, self.final_filename, max_workers=self.max_workers)
+        to_export = changes_to_export(diff, moved, self.out_path, self.final_filename,
+                                      peaks=self.peaks, streaming=self.streaming)
+        lane = INTERACTIVE if len({c.audio_file for c in to_export}) <= _INTERACTIVE_MAX_FILES else BULK
+        for change in to_export:
+            # an export of the old version may still be running and write its cut after apply_file_changes
+            stale = self._stale_outputs(change) if RETIMED in change.kinds else ()
+            self.enqueue(lane, change.audio_file, change.new_name, change.new, stale=stale)
+        print(f"  - Sessions queued: {len(to_export)} ({'interactive' if lane == INTERACTIVE else 'bulk'})")
+
+    def _stale_outputs(self, change):
+        new = session_outputs(change.audio_file, change.new_name, change.new, self.out_path, self.final_filename,
+                              peaks=True, streaming=True)
+        return stale_outputs(change, self.out_path, self.final_filename) + rendition_files(new)
+
+    def _queue_backlog(self, diff):
+        queued = 0
+        sessions, index = None, {}
+        for change in diff.changes:
+            if self.stop.is_set():
+                return
+            # the catalog may have been edited since startup: queue the session as it is now, and never
+            # in place of an edit already queued
+            if self.sessions is not sessions:
+                sessions = self.sessions
+                index = index_sessions(sessions)
+            if change.key not in index:
+                continue
+            audio_file, s_name, s = index[change.key]
+            if check_session_needs_export(audio_file, s_name, s, self.out_path, self.final_filename,
+                                          peaks=self.peaks, streaming=self.streaming):
+                queued += self.enqueue(BACKLOG, audio_file, s_name, s, only_new=True)
+        print(f"\nBacklog scan complete: {queued} sessions queued")
+
+    # ---- export side --------------------------------------------------------------------------------------
+
+    def _worker(self):
+        while not self.stop.is_set():
+            try:
+                (lane, _, generation), key, (audio_file, s_name, s, stale) = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                with self.latest_lock:
+                    if self.latest.get(key) != generation:
+                        continue  # superseded by a later edit of the same session
+                    del self.latest[key]
+                    export_lock = self.exporting[key]
+                with export_lock:
+                    if stale:
+                        remove_stale_outputs(stale, self.out_path)
+                    audio = self.audio.get(audio_file, s)
+                    if audio is None:
+                        continue
+                    task = (audio_file, s_name, s, self.out_path, self.final_filename)
+                    result = export_single_session(task, {audio_file: audio}, peaks=self.peaks,
+                                                   streaming=self.streaming, loudness=self.loudness)
+                print(f"  [{'interactive' if lane == INTERACTIVE else 'bulk' if lane == BULK else 'backlog'}] {result}")
+            except Exception as e:
+                errors.append(f"Error exporting {audio_file} {s_name}: {e}")
+                print(f"  ✗ {audio_file} {s_name}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def run(self):
+        workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.max_workers)]
+        for w in workers:
+            w.start()
+        print(f"Watching {self.catalog} (Ctrl+C to stop)...")
+        try:
+            while not self.stop.is_set():
+                self._fetch()
+                if self._changed():
+                    try:
+                        self.reload()
+                    except (OSError, ValueError, KeyError) as e:
+                        # most likely a TSV caught while being saved: retry on the next poll
+                        print(f"Could not parse {self.catalog}: {e}")
+                        self.stamp = None
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            print("\nStopping...")
+        finally:
+            self.stop.set()
+            for w in workers:
+                w.join()
+
+
+def watch_catalog(catalog, audio_path, out_path, final_filename=True, pass_missing=True, catalog_url=None,
+                  interval=2.0, max_workers=4, peaks=False, streaming=False, backlog=True, loudness=None):
+    """Export sessions as the catalog is edited: hand edits of a side within seconds, the backlog in the background"""
+    CatalogWatcher(catalog, audio_path, out_path,
+                   final_filename=final_filename,
+                   pass_missing=pass_missing,
+                   catalog_url=catalog_url,
+                   interval=interval,
+                   max_workers=max_workers,
+                   peaks=peaks,
+                   streaming=streaming,
+                   backlog=backlog,
+                   loudness=loudness).run()
@@ -1,14 +1,30 @@
 from pathlib import Path
+from shutil import copy
 from urllib.request import urlretrieve
 
 from process_recordings import export_teachings, export_final_files
-from process_recordings.chunk_recordings import export_renamed_sessions
+from process_recordings.chunk_recordings import export_renamed_sessions, prune_stale_outputs, errors
+from process_recordings.catalog_diff import export_catalog_delta
+from process_recordings.boundaries import detect_boundaries
+from process_recordings.watch import watch_catalog
+from process_recordings.verify import verify_outputs, reexport_failed
+from process_recordings.alignment import align_sources
+from process_recordings.fingerprint import index_sources, find_duplicates
+from process_recordings.retag import retag_outputs
 
 # modes:
 # 1. Segmentation process: export individual sessions from the cassette sides + resegment sessions when needed
-# 2. same as above, but for restored audio
-# 3. export individual renamed sessions in New Archives
+# 2. same as above, but for restored audio (timecodes shifted by the measured offset/drift of each restored side)
+# 3. export individual renamed sessions in New Archives, with the waveform peaks of the dashboard
+#    and the Opus/HLS streaming renditions
 # 4. same as above, but for restored audio
+# 5. same as 3, but only act on what changed since the previous run's catalog (moves instead of re-exports,
+#    tag rewrites instead of re-exports for new titles/authors)
+# 6. pre-fill start/end of the cassette sides not yet cataloged with candidate boundaries found in the silences
+# 7. keep running: export to New Archives as the catalog is edited, the side being worked on first
+# 8. check the files of New Archives against the catalog, then re-export the faulty ones
+# 9. fingerprint the source recordings and list the ones digitized twice or copied into several folders
+# 10. rewrite the tags of New Archives (project wording, text title, author, starting from:) without re-encoding
 mode = 4
 
 if mode == 1:
@@ -31,8 +47,11 @@ if mode == 2:
 
     audio_path = Path('/media/drupchen/Khyentse Önang/NAS/Cleaned by Thubten')
     out_path = Path('/media/drupchen/Khyentse Önang/NAS/Cleaned by Thubten in Sessions')
+    original_path = Path('/media/drupchen/Khyentse Önang/NAS/Original Files')
     cassette_side_to_resegment = '111 A-Dzogchen Lamrim Yigdrupa'
     cassette_side_to_resegment = ''
+    # only the sides new or changed since the last run are measured; the export picks the map up from out_path
+    align_sources(Path(filename), original_path, audio_path, out_path)
     export_teachings(Path(filename), audio_path, out_path, pass_missing=True, single_file=cassette_side_to_resegment)
 
 if mode == 3:
@@ -47,7 +66,16 @@ if mode == 3:
     out_path = Path('/media/drupchen/Khyentse Önang/NAS/New Archives')
     cassette_side_to_resegment = 'AUDIO Khyentse Rinpoche WAV/176 A-Kyerim'  # folder required
     cassette_side_to_resegment = ''
-    export_renamed_sessions(Path(filename), audio_path, out_path, pass_missing=True, single_file=cassette_side_to_resegment)
+    # each side in its own worker process: a corrupt side or a stuck encode is killed and quarantined
+    # (New Archives/.quarantine.jsonl) instead of stopping the run
+    isolate = {'processes': 2, 'timeout': 2 * 3600}
+    # measure each session into New Archives/.loudness.jsonl and ReplayGain tags; -16 (LUFS) would also normalize
+    # the MP3 and streaming files (never the WAV)
+    loudness = True
+    export_renamed_sessions(Path(filename), audio_path, out_path, pass_missing=True, single_file=cassette_side_to_resegment,
+                            peaks=True, streaming=True, isolate=isolate, loudness=loudness)
+    # outputs left behind by sessions renamed or removed from the catalog: listed, remove=True deletes them
+    prune_stale_outputs(Path(filename), out_path, final_filename=True, remove=False)
 
 if mode == 4:
     # download from Google Drive
@@ -59,7 +87,66 @@ if mode == 4:
 
     audio_path = Path('/media/drupchen/Khyentse Önang/NAS/Cleaned by Thubten')
     out_path = Path('/media/drupchen/Khyentse Önang/NAS/New Archives_Restored')
+    original_path = Path('/media/drupchen/Khyentse Önang/NAS/Original Files')
+    align_sources(Path(filename), original_path, audio_path, out_path)
     cassette_side_to_resegment = 'AUDIO Khyentse Rinpoche WAV/176 A-Kyerim'  # folder required
     cassette_side_to_resegment = ''
     export_renamed_sessions(Path(filename), audio_path, out_path, pass_missing=True, single_file=cassette_side_to_resegment)
 
+
+
+if mode == 5:
+    # download from Google Drive, keeping the catalog of the last successful run to diff against
+    catalog_url = 'https://docs.google.com/spreadsheets/d/e/2PACX-1vSGcAAMyJQYeR91n_9JF84BUpuMdHu4sxXBIrkLhEHCPe_F_rD_8YK9y6pzmCPK1adBPEQWzQ9Aynn4/pub?gid=2035952658&single=true&output=tsv'
+    filename = Path("input/audio $archives - sessions.tsv")
+    previous = Path("input/audio $archives - sessions - previous run.tsv")
+    urlretrieve(catalog_url, filename)
+
+    audio_path = Path('/media/drupchen/Khyentse Önang/NAS/Original Files')
+    out_path = Path('/media/drupchen/Khyentse Önang/NAS/New Archives')
+    export_catalog_delta(previous, filename, audio_path, out_path, pass_missing=True, final_filename=True,
+                         peaks=True, streaming=True)
+    # sessions that failed are diffed again next time
+    if not errors:
+        copy(filename, previous)
+
+if mode == 6:
+    filename = "input/audio $archives - sessions.tsv"
+    audio_path = Path('/media/drupchen/Khyentse Önang/NAS/Original Files')
+    folders = ['AUDIO Khyentse Rinpoche WAV']  # None for all folders
+    detect_boundaries(audio_path, 'output/candidate boundaries.tsv', folders=folders, skip_catalog=filename)
+
+if mode == 7:
+    catalog_url = 'https://docs.google.com/spreadsheets/d/e/2PACX-1vSGcAAMyJQYeR91n_9JF84BUpuMdHu4sxXBIrkLhEHCPe_F_rD_8YK9y6pzmCPK1adBPEQWzQ9Aynn4/pub?gid=2035952658&single=true&output=tsv'
+    catalog_url = None  # only watch the local TSV
+    filename = Path("input/audio $archives - sessions.tsv")
+
+    audio_path = Path('/media/drupchen/Khyentse Önang/NAS/Original Files')
+    out_path = Path('/media/drupchen/Khyentse Önang/NAS/New Archives')
+    watch_catalog(filename, audio_path, out_path, final_filename=True, catalog_url=catalog_url,
+                  peaks=True, streaming=True)
+
+if mode == 8:
+    filename = Path("input/audio $archives - sessions.tsv")
+    audio_path = Path('/media/drupchen/Khyentse Önang/NAS/Original Files')
+    out_path = Path('/media/drupchen/Khyentse Önang/NAS/New Archives')
+    report = Path('output/new archives verification.json')
+    result = verify_outputs(filename, audio_path, out_path, final_filename=True, peaks=True, streaming=True,
+                            decode=False, report=report)
+    reexport_failed(result, filename, audio_path, peaks=True, streaming=True)
+
+if mode == 9:
+    audio_path = Path('/media/drupchen/Khyentse Önang/NAS/Original Files')
+    index = Path('output/source fingerprints.sqlite')  # only new or changed recordings are fingerprinted again
+    folders = None  # None for all folders
+    index_sources(audio_path, index, folders=folders)
+    find_duplicates(index, 'output/duplicate recordings.tsv')
+
+if mode == 10:
+    catalog_url = 'https://docs.google.com/spreadsheets/d/e/2PACX-1vSGcAAMyJQYeR91n_9JF84BUpuMdHu4sxXBIrkLhEHCPe_F_rD_8YK9y6pzmCPK1adBPEQWzQ9Aynn4/pub?gid=2035952658&single=true&output=tsv'
+    filename = "input/audio $archives - sessions.tsv"
+    urlretrieve(catalog_url, filename)
+
+    out_path = Path('/media/drupchen/Khyentse Önang/NAS/New Archives')
+    # files whose tags are already right are only read
+    retag_outputs(Path(filename), out_path, final_filename=True)